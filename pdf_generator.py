@@ -1,18 +1,59 @@
 from __future__ import annotations
 
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional, Union, BinaryIO
+from typing import Any, Callable, Iterable, Iterator, Optional, Union, BinaryIO
+import copy
+import hashlib
+import io
+import math
 import re
+import time
 
 from reportlab.lib import colors
+from reportlab.lib.boxstuff import aspectRatioFix
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfdoc
 from reportlab.pdfgen import canvas
 from PIL import Image
 
+from text_metrics import string_width, truncate_lines, wrap_text
 
-@dataclass
+# Uploaded images may be given as a file path or kept in memory as raw
+# encoded bytes (or a reportlab ImageReader wrapping them).
+ImageSource = Union[str, bytes, bytearray, memoryview, ImageReader]
+
+
+# Optional timing hook, called with a stage name and its duration in
+# seconds. The server points it at its metrics; unset, nothing is timed.
+StageObserver = Callable[[str, float], None]
+_stage_observer: Optional[StageObserver] = None
+
+
+def set_stage_observer(observer: Optional[StageObserver]) -> None:
+    global _stage_observer
+    _stage_observer = observer
+
+
+@contextmanager
+def _stage(name: str) -> Iterator[None]:
+    observer = _stage_observer
+    if observer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observer(name, time.perf_counter() - start)
+
+
+# Slotted: one is built per request and per batch entry, and shipped to the
+# render workers.
+@dataclass(slots=True)
 class FlyerData:
     texto1: str
     color_texto1: str
@@ -20,7 +61,7 @@ class FlyerData:
     color_texto_marca: str
     texto2: str
     color_texto2: str
-    texto2_fondo: Optional[str]
+    texto2_fondo: Optional[ImageSource]
     texto3: str
     color_texto3: str
     texto4: str
@@ -64,25 +105,108 @@ class FlyerData:
     imagen4_modo: str
     imagen4_custom_ancho: float
     imagen4_custom_alto: float
-    imagen1: Optional[str]
-    imagen2: Optional[str]
-    imagen3: Optional[str]
-    imagen4: Optional[str]
-    qr_imagen: Optional[str]
+    imagen1: Optional[ImageSource]
+    imagen2: Optional[ImageSource]
+    imagen3: Optional[ImageSource]
+    imagen4: Optional[ImageSource]
+    qr_imagen: Optional[ImageSource]
 
 
 PAGE_W, PAGE_H = A4
+HEADER_LOGO_X = PAGE_W - 60 * mm
 ASSETS_DIR = Path(__file__).resolve().parent / "assets"
 LEGAL_TEXT = (
     "En cumplimiento del decreto de la Junta de Andalucía 218/2005 del 11 de octubre, "
     "se informa al cliente que los gastos notariales, registrales, ITP y otros gastos "
     "inherentes a la compraventa no están incluidos en la venta."
 )
+PRINT_IMAGE_DPI = 300.0
+SCREEN_IMAGE_DPI = 150.0
+PHOTO_CELL_BACKGROUND = "#f1f1f1"
+STATIC_ASSET_FILES = (
+    "logo_new_home.png",
+    "certificado.png",
+    "dormitorio.png",
+    "aseo.png",
+    "jardin.png",
+    "garaje.png",
+    "piscina.png",
+)
 
 
-def _draw_image_fit(
-    c: canvas.Canvas,
-    path: str,
+@dataclass(frozen=True)
+class StaticAsset:
+    name: str
+    reader: ImageReader
+    width: int
+    height: int
+    xobject: pdfdoc.PDFImageXObject
+
+
+_STATIC_ASSETS: dict[str, StaticAsset] = {}
+
+
+def load_static_assets() -> dict[str, StaticAsset]:
+    for filename in STATIC_ASSET_FILES:
+        _static_asset(filename)
+    return _STATIC_ASSETS
+
+
+def _static_asset(filename: str) -> Optional[StaticAsset]:
+    asset = _STATIC_ASSETS.get(filename)
+    if asset is not None:
+        return asset
+    path = ASSETS_DIR / filename
+    if not path.exists():
+        return None
+    # Decode and compress once per process; every canvas then embeds the
+    # same pre-built stream instead of re-reading the PNG from disk.
+    name = "asset_" + hashlib.sha1(path.read_bytes()).hexdigest()
+    reader = ImageReader(str(path))
+    reader.getRGBData()
+    xobject = pdfdoc.PDFImageXObject(name, reader, mask="auto")
+    width, height = reader.getSize()
+    asset = StaticAsset(name=name, reader=reader, width=width, height=height, xobject=xobject)
+    _STATIC_ASSETS[filename] = asset
+    return asset
+
+
+def _draw_static_asset(c: canvas.Canvas, asset: StaticAsset, x: float, y: float, w: float, h: float) -> None:
+    if not isinstance(c, canvas.Canvas):
+        c.drawAsset(asset, x, y, w, h)
+        return
+    doc = c._doc
+    reg_name = doc.getXObjectName(asset.name)
+    if doc.idToObject.get(reg_name) is None:
+        # Same registration canvas.drawImage performs, minus the decode and
+        # digest of the pixel data.
+        img_obj = copy.copy(asset.xobject)
+        c._setXObjects(img_obj)
+        doc.Reference(img_obj, reg_name)
+        doc.addForm(asset.name, img_obj)
+        smask = getattr(img_obj, "_smask", None)
+        if smask is not None:
+            m_reg_name = doc.getXObjectName(smask.name)
+            if doc.idToObject.get(m_reg_name) is None:
+                smask = copy.copy(smask)
+                c._setXObjects(smask)
+                img_obj.smask = doc.Reference(smask, m_reg_name)
+            else:
+                img_obj.smask = pdfdoc.PDFObjectReference(m_reg_name)
+            del img_obj._smask
+
+    c._currentPageHasImages = 1
+    c.saveState()
+    c.translate(x, y)
+    c.scale(w, h)
+    c._code.append(f"/{reg_name} Do")
+    c.restoreState()
+    c._formsinuse.append(asset.name)
+
+
+def _fit_rect(
+    img_w: float,
+    img_h: float,
     x: float,
     y: float,
     w: float,
@@ -90,18 +214,16 @@ def _draw_image_fit(
     scale: float = 1.0,
     offset_x: float = 0.0,
     offset_y: float = 0.0,
-) -> None:
-    with Image.open(path) as img:
-        img_w, img_h = img.size
-        img_ratio = img_w / img_h
-        box_ratio = w / h
+) -> tuple[float, float, float, float]:
+    img_ratio = img_w / img_h
+    box_ratio = w / h
 
-        if img_ratio > box_ratio:
-            draw_w = w
-            draw_h = w / img_ratio
-        else:
-            draw_h = h
-            draw_w = h * img_ratio
+    if img_ratio > box_ratio:
+        draw_w = w
+        draw_h = w / img_ratio
+    else:
+        draw_h = h
+        draw_w = h * img_ratio
 
     scale = max(0.01, min(scale, 1.0))
     draw_w *= scale
@@ -114,19 +236,167 @@ def _draw_image_fit(
 
     draw_x = x + (w - draw_w) / 2 + (extra_w / 2) * (offset_x / 100)
     draw_y = y + (h - draw_h) / 2 + (extra_h / 2) * (offset_y / 100)
-    c.drawImage(path, draw_x, draw_y, draw_w, draw_h, preserveAspectRatio=True, mask='auto')
+    return draw_x, draw_y, draw_w, draw_h
+
+
+def _draw_asset_fit(c: canvas.Canvas, filename: str, x: float, y: float, w: float, h: float) -> bool:
+    asset = _static_asset(filename)
+    if asset is None:
+        return False
+    draw_x, draw_y, draw_w, draw_h = _fit_rect(asset.width, asset.height, x, y, w, h)
+    _draw_static_asset(c, asset, draw_x, draw_y, draw_w, draw_h)
+    return True
+
+
+@contextmanager
+def _open_image_source(source: ImageSource) -> Iterator[tuple[Image.Image, Union[str, ImageReader]]]:
+    # Yields the PIL image (for sizing/resampling) together with what should
+    # be handed to drawImage. Paths stay paths so reportlab keeps its cheap
+    # filename-based dedup; in-memory sources are wrapped once.
+    if isinstance(source, str):
+        with Image.open(source) as img:
+            yield img, source
+        return
+    reader = source if isinstance(source, ImageReader) else ImageReader(io.BytesIO(source))
+    yield reader._image, reader
+
+
+def _resample_size(
+    img: Image.Image,
+    draw_w: float,
+    draw_h: float,
+    target_dpi: Optional[float],
+) -> Optional[tuple[int, int]]:
+    if not target_dpi or draw_w <= 0 or draw_h <= 0:
+        return None
+    img_w, img_h = img.size
+    need_w = math.ceil(draw_w / 72.0 * target_dpi)
+    need_h = math.ceil(draw_h / 72.0 * target_dpi)
+    ratio = max(need_w / img_w, need_h / img_h)
+    if ratio >= 1.0:
+        return None
+    return max(1, round(img_w * ratio)), max(1, round(img_h * ratio))
+
+
+def _resample_for_box(
+    img: Image.Image,
+    draw_w: float,
+    draw_h: float,
+    target_dpi: Optional[float],
+    background: Optional[str] = None,
+) -> Optional[ImageReader]:
+    size = _resample_size(img, draw_w, draw_h, target_dpi)
+    has_alpha = img.mode in {"RGBA", "LA", "PA"} or (img.mode == "P" and "transparency" in img.info)
+    # Over a flat ``background`` a transparent image is composited here and
+    # embedded as JPEG instead of as Flate data plus a soft mask. Only when
+    # embedding at a target resolution: the raster canvas composites itself.
+    flatten = has_alpha and background is not None and target_dpi is not None
+    if size is None and not flatten:
+        return None
+
+    if size is not None:
+        # Let the JPEG decoder skip most of the work (DCT scaling) before the
+        # final high quality resample down to the exact size.
+        img.draft("RGB", size)
+    if has_alpha:
+        resized = img.convert("RGBA")
+        if size is not None:
+            resized = resized.resize(size, Image.LANCZOS)
+        if not flatten:
+            return ImageReader(resized)
+        flat = Image.new("RGB", resized.size, background)
+        flat.paste(resized, mask=resized.getchannel("A"))
+        resized = flat
+    else:
+        resized = img.convert("RGB").resize(size, Image.LANCZOS)
+    buffer = io.BytesIO()
+    resized.save(buffer, format="JPEG", quality=90, optimize=False)
+    buffer.seek(0)
+    return ImageReader(buffer)
+
+
+# Photos already embedded in a multi-page document, keyed by their content
+# and embedded pixel size (see generate_catalog).
+SharedImages = dict[tuple[str, Optional[tuple[int, int]], Optional[str]], StaticAsset]
+
+
+def _prepare_photo(
+    image: ImageSource,
+    img: Image.Image,
+    source: Union[str, ImageReader],
+    draw_w: float,
+    draw_h: float,
+    target_dpi: Optional[float],
+    shared: Optional[SharedImages],
+    background: Optional[str] = None,
+) -> Union[str, ImageReader, StaticAsset]:
+    if shared is None or not isinstance(image, (str, bytes, bytearray, memoryview)):
+        return _resample_for_box(img, draw_w, draw_h, target_dpi, background) or source
+    # The same photo at the same embedded size is decoded, resampled and
+    # compressed once per document and drawn from then on by reference.
+    origin = image if isinstance(image, str) else hashlib.sha1(image).hexdigest()
+    key = (origin, _resample_size(img, draw_w, draw_h, target_dpi), background)
+    asset = shared.get(key)
+    if asset is None:
+        reader = _resample_for_box(img, draw_w, draw_h, target_dpi, background)
+        if reader is None:
+            reader = source if isinstance(source, ImageReader) else ImageReader(source)
+        name = "photo_" + hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        xobject = pdfdoc.PDFImageXObject(name, reader, mask="auto")
+        width, height = reader.getSize()
+        asset = StaticAsset(name=name, reader=reader, width=width, height=height, xobject=xobject)
+        shared[key] = asset
+    return asset
+
+
+def _draw_photo(
+    c: canvas.Canvas,
+    photo: Union[str, ImageReader, StaticAsset],
+    x: float,
+    y: float,
+    w: float,
+    h: float,
+    preserve_aspect: bool,
+) -> None:
+    if not isinstance(photo, StaticAsset):
+        c.drawImage(photo, x, y, w, h, preserveAspectRatio=preserve_aspect, mask='auto')
+        return
+    # Same placement drawImage computes from the embedded pixel size.
+    x, y, w, h, _ = aspectRatioFix(preserve_aspect, "c", x, y, w, h, photo.width, photo.height)
+    _draw_static_asset(c, photo, x, y, w, h)
+
+
+def _draw_image_fit(
+    c: canvas.Canvas,
+    image: ImageSource,
+    x: float,
+    y: float,
+    w: float,
+    h: float,
+    scale: float = 1.0,
+    offset_x: float = 0.0,
+    offset_y: float = 0.0,
+    shared: Optional[SharedImages] = None,
+) -> None:
+    with _open_image_source(image) as (img, source):
+        img_w, img_h = img.size
+        draw_x, draw_y, draw_w, draw_h = _fit_rect(img_w, img_h, x, y, w, h, scale, offset_x, offset_y)
+        photo = _prepare_photo(image, img, source, draw_w, draw_h, None, shared)
+    _draw_photo(c, photo, draw_x, draw_y, draw_w, draw_h, True)
 
 
 def _draw_image_cover(
     c: canvas.Canvas,
-    path: str,
+    image: ImageSource,
     x: float,
     y: float,
     w: float,
     h: float,
     scale: float = 1.0,
+    target_dpi: Optional[float] = None,
+    shared: Optional[SharedImages] = None,
 ) -> None:
-    with Image.open(path) as img:
+    with _open_image_source(image) as (img, source):
         img_w, img_h = img.size
         img_ratio = img_w / img_h
         box_ratio = w / h
@@ -139,9 +409,10 @@ def _draw_image_cover(
             draw_w = w
             draw_h = w / img_ratio
 
-    scale = max(0.1, min(scale, 1.0))
-    draw_w *= scale
-    draw_h *= scale
+        scale = max(0.1, min(scale, 1.0))
+        draw_w *= scale
+        draw_h *= scale
+        photo = _prepare_photo(image, img, source, draw_w, draw_h, target_dpi, shared)
 
     draw_x = x + (w - draw_w) / 2
     draw_y = y + (h - draw_h) / 2
@@ -150,13 +421,13 @@ def _draw_image_cover(
     c.saveState()
     # Clip to the target box so oversize images are cropped to fit.
     c.clipPath(clip, stroke=0, fill=0)
-    c.drawImage(path, draw_x, draw_y, draw_w, draw_h, preserveAspectRatio=True, mask='auto')
+    _draw_photo(c, photo, draw_x, draw_y, draw_w, draw_h, True)
     c.restoreState()
 
 
 def _draw_image_by_mode(
     c: canvas.Canvas,
-    path: str,
+    image: ImageSource,
     x: float,
     y: float,
     w: float,
@@ -167,9 +438,12 @@ def _draw_image_by_mode(
     offset_y: float,
     custom_w_pct: float,
     custom_h_pct: float,
+    target_dpi: Optional[float] = None,
+    shared: Optional[SharedImages] = None,
+    background: Optional[str] = None,
 ) -> None:
     mode = _safe_image_mode(mode)
-    with Image.open(path) as img:
+    with _stage("image_prepare"), _open_image_source(image) as (img, source):
         img_w, img_h = img.size
         img_ratio = img_w / img_h
         box_ratio = w / h
@@ -192,13 +466,17 @@ def _draw_image_by_mode(
             draw_w = w
             draw_h = h
 
-    if mode == "custom":
-        draw_w *= _safe_dimension_percent(custom_w_pct) / 100.0
-        draw_h *= _safe_dimension_percent(custom_h_pct) / 100.0
-    else:
-        draw_scale = _safe_scale(scale)
-        draw_w *= draw_scale
-        draw_h *= draw_scale
+        if mode == "custom":
+            draw_w *= _safe_dimension_percent(custom_w_pct) / 100.0
+            draw_h *= _safe_dimension_percent(custom_h_pct) / 100.0
+        else:
+            draw_scale = _safe_scale(scale)
+            draw_w *= draw_scale
+            draw_h *= draw_scale
+
+        # A phone photo is usually far denser than its grid cell needs;
+        # embed it at the target resolution instead of the original pixels.
+        photo = _prepare_photo(image, img, source, draw_w, draw_h, target_dpi, shared, background)
 
     base_x = x + (w - draw_w) / 2
     base_y = y + (h - draw_h) / 2
@@ -211,39 +489,93 @@ def _draw_image_by_mode(
     clip.rect(x, y, w, h)
     c.saveState()
     c.clipPath(clip, stroke=0, fill=0)
-    c.drawImage(
-        path,
-        draw_x,
-        draw_y,
-        draw_w,
-        draw_h,
-        preserveAspectRatio=mode in {"contain", "cover"},
-        mask='auto',
-    )
+    _draw_photo(c, photo, draw_x, draw_y, draw_w, draw_h, mode in {"contain", "cover"})
     c.restoreState()
 
 
-def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
+def generate_pdf(
+    data: FlyerData,
+    output_path: Union[str, BinaryIO],
+    image_dpi: Optional[float] = PRINT_IMAGE_DPI,
+    layers: str = "all",
+) -> None:
     c = canvas.Canvas(output_path, pagesize=A4)
-
-    # Background
-    c.setFillColor(colors.white)
-    c.rect(0, 0, PAGE_W, PAGE_H, fill=1, stroke=0)
-
-    # Top header bar
+    with _stage("draw"):
+        draw_flyer(c, data, image_dpi=image_dpi, layers=layers)
+    with _stage("pdf_serialize"):
+        c.showPage()
+        c.save()
+
+
+def generate_catalog(
+    flyers: Iterable[FlyerData],
+    output_path: Union[str, BinaryIO],
+    image_dpi: Optional[float] = PRINT_IMAGE_DPI,
+) -> int:
+    # One flyer per page in a single document. The static assets are
+    # registered once per document already; photos repeated across listings
+    # are embedded once as well. Returns the number of pages.
+    c = canvas.Canvas(output_path, pagesize=A4)
+    shared_images: SharedImages = {}
+    pages = 0
+    for data in flyers:
+        with _stage("draw"):
+            draw_flyer(c, data, image_dpi=image_dpi, shared_images=shared_images)
+        with _stage("pdf_serialize"):
+            c.showPage()
+        pages += 1
+    with _stage("pdf_serialize"):
+        c.save()
+    return pages
+
+
+def draw_flyer(
+    c: canvas.Canvas,
+    data: FlyerData,
+    image_dpi: Optional[float] = PRINT_IMAGE_DPI,
+    layers: str = "all",
+    shared_images: Optional[SharedImages] = None,
+) -> None:
+    # Draws one flyer page on ``c``: a reportlab canvas or anything exposing
+    # the same drawing calls (see server/raster_canvas.py).
+    # ``layers`` splits the page for layered previews: "static" draws only
+    # the chrome that is identical for every flyer, "dynamic" everything
+    # else on a transparent page, "all" the complete flyer.
+    # ``shared_images`` reuses embedded photos across the pages of one
+    # document.
     header_h = 20 * mm
-    c.setFillColor(colors.HexColor("#213502"))
-    c.rect(0, PAGE_H - header_h, PAGE_W, header_h, fill=1, stroke=0)
+    footer_top = 18 * mm
+    price_y = footer_top - 2 * mm
+    energy_x = 10 * mm
+    energy_img_w = 30 * mm
+    energy_img_h = 30 * mm
+    energy_img_y = price_y + 10 * mm
+
+    has_logo = _static_asset("logo_new_home.png") is not None
+    if layers == "static":
+        _draw_page_base(c, header_h)
+        _draw_header_logo(c, header_h)
+        _draw_energy_certificate(c, energy_x, energy_img_y, energy_img_w, energy_img_h)
+        return
+    # In "all" mode the chrome is painted in between the flyer content, in
+    # the original order (the logo over the title, the price label over the
+    # energy arrow), so the full page is unchanged by the layer split. The
+    # dynamic layer is composited over the static one, so chrome that goes
+    # over content is drawn there: the price label always, and the logo
+    # again when the title reaches into its box.
+    chrome = layers != "dynamic"
+    if chrome:
+        _draw_page_base(c, header_h)
 
     c.setFillColor(_safe_color(data.color_texto1, colors.white))
     c.setFont("Helvetica-Bold", 22)
     header_y = PAGE_H - header_h / 2 - 8
-    c.drawString(12 * mm, header_y, data.texto1.upper() or "TEXTO 1")
+    title = data.texto1.upper() or "TEXTO 1"
+    c.drawString(12 * mm, header_y, title)
 
-    logo_path = ASSETS_DIR / "logo_new_home.png"
-    if logo_path.exists():
-        _draw_image_fit(c, str(logo_path), PAGE_W - 60 * mm, PAGE_H - header_h + 2 * mm, 48 * mm, header_h - 4 * mm)
-    else:
+    if chrome or (has_logo and 12 * mm + string_width(title, "Helvetica-Bold", 22) > HEADER_LOGO_X):
+        _draw_header_logo(c, header_h)
+    if not has_logo:
         c.setFont("Helvetica-Bold", 20)
         c.setFillColor(_safe_color(data.color_texto_marca, colors.white))
         c.drawRightString(PAGE_W - 12 * mm, header_y, data.texto_marca or "TEXTO MARCA")
@@ -251,7 +583,16 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
     # Subheader
     sub_h = 12 * mm
     if data.texto2_fondo:
-        _draw_image_cover(c, data.texto2_fondo, 0, PAGE_H - header_h - sub_h, PAGE_W, sub_h)
+        _draw_image_cover(
+            c,
+            data.texto2_fondo,
+            0,
+            PAGE_H - header_h - sub_h,
+            PAGE_W,
+            sub_h,
+            target_dpi=image_dpi,
+            shared=shared_images,
+        )
     else:
         c.setFillColor(colors.HexColor("#c9e0cb"))
         c.rect(0, PAGE_H - header_h - sub_h, PAGE_W, sub_h, fill=1, stroke=0)
@@ -267,128 +608,14 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
     c.drawRightString(PAGE_W - 12 * mm, sub_y, texto3)
 
     top_area_bottom_y = PAGE_H - header_h - sub_h
-
-    footer_top = 18 * mm
     footer_max_h = 18 * mm
-    price_y = footer_top - 2 * mm
-
-    energy_x = 10 * mm
-    energy_img_w = 30 * mm
-    energy_img_h = 30 * mm
-    energy_img_y = price_y + 10 * mm
 
     min_margin = 3 * mm
     bottom_area_top_y = energy_img_y + energy_img_h + 2 * mm
     available_height = top_area_bottom_y - bottom_area_top_y
 
-    min_block_scale = 0.90
-    max_block_scale = 1.08
-    scale_step = 0.01
-    desc_font_min = 8.0
-
-    desc_font_size = _safe_description_font_size(data.descripcion_tamano)
-    if len(data.descripcion or "") > 1000:
-        desc_font_size = max(desc_font_min, desc_font_size - 1.0)
-
-    def compute_layout(scale: float, spacing_ratio: float, font_size: float) -> dict:
-        top_gap = 6 * mm * spacing_ratio
-        grid_h = 110 * mm * scale
-        grid_w = PAGE_W - 20 * mm
-        grid_gap = 4 * mm
-        icon_row_h = 14 * mm * scale
-        grid_to_icons_gap = 12 * mm * spacing_ratio
-        icons_to_desc_gap = 10 * mm * spacing_ratio
-        qr_size = 30 * mm * scale
-        desc_x = 10 * mm + qr_size + 6 * mm
-        desc_w = PAGE_W - desc_x - 10 * mm
-        line_h = max(3.2 * mm, font_size * 1.3)
-        desc_lines = _wrap_text_to_width(c, data.descripcion or "", "Helvetica", font_size, desc_w)
-        desc_h = len(desc_lines) * line_h
-        desc_row_h = max(qr_size, desc_h + 2 * mm)
-        block_h = top_gap + grid_h + grid_to_icons_gap + icon_row_h + icons_to_desc_gap + desc_row_h
-        remaining = available_height - block_h
-        return {
-            "scale": scale,
-            "top_gap": top_gap,
-            "grid_h": grid_h,
-            "grid_w": grid_w,
-            "grid_gap": grid_gap,
-            "icon_row_h": icon_row_h,
-            "grid_to_icons_gap": grid_to_icons_gap,
-            "icons_to_desc_gap": icons_to_desc_gap,
-            "qr_size": qr_size,
-            "desc_x": desc_x,
-            "desc_w": desc_w,
-            "desc_font_size": font_size,
-            "line_h": line_h,
-            "desc_lines": desc_lines,
-            "desc_h": desc_h,
-            "desc_row_h": desc_row_h,
-            "block_h": block_h,
-            "remaining": remaining,
-        }
-
-    def scale_range(start: float, end: float, step: float) -> list[float]:
-        values = []
-        current = start
-        while current >= end - 1e-9:
-            values.append(round(current, 2))
-            current -= step
-        return values
-
-    base_layout = compute_layout(1.0, 1.0, desc_font_size)
-    prefer_scale_up = base_layout["remaining"] > 20 * mm
-    candidate_scales = scale_range(max_block_scale if prefer_scale_up else 1.0, min_block_scale, scale_step)
-
-    layout = None
-    for scale in candidate_scales:
-        candidate = compute_layout(scale, 1.0, desc_font_size)
-        if candidate["remaining"] >= 2 * min_margin:
-            layout = candidate
-            break
-
-    if layout is None:
-        for scale in scale_range(1.0, min_block_scale, scale_step):
-            candidate = compute_layout(scale, 0.88, desc_font_size)
-            if candidate["remaining"] >= 2 * min_margin:
-                layout = candidate
-                break
-
-    if layout is None:
-        font_size = desc_font_size
-        while font_size >= desc_font_min:
-            candidate = compute_layout(min_block_scale, 0.82, font_size)
-            if candidate["remaining"] >= 2 * min_margin:
-                layout = candidate
-                break
-            font_size -= 0.5
-
-    if layout is None:
-        layout = compute_layout(min_block_scale, 0.80, desc_font_min)
-        fixed_part_h = (
-            layout["top_gap"]
-            + layout["grid_h"]
-            + layout["grid_to_icons_gap"]
-            + layout["icon_row_h"]
-            + layout["icons_to_desc_gap"]
-        )
-        max_desc_row_h = max(layout["qr_size"], available_height - fixed_part_h - 2 * min_margin)
-        max_desc_h = max(0.0, max_desc_row_h - 2 * mm)
-        max_lines = max(1, int(max_desc_h // layout["line_h"]))
-        truncated = _truncate_lines_to_count(
-            c,
-            layout["desc_lines"],
-            max_lines,
-            "Helvetica",
-            layout["desc_font_size"],
-            layout["desc_w"],
-        )
-        used_desc_h = len(truncated) * layout["line_h"]
-        layout["desc_lines"] = truncated
-        layout["desc_h"] = used_desc_h
-        layout["desc_row_h"] = max(layout["qr_size"], used_desc_h + 2 * mm)
-        layout["block_h"] = fixed_part_h + layout["desc_row_h"]
-        layout["remaining"] = available_height - layout["block_h"]
+    with _stage("layout"):
+        layout = _solve_layout(data.descripcion or "", data.descripcion_tamano, available_height, min_margin)
 
     remaining = max(0.0, layout["remaining"])
     if remaining >= 2 * min_margin:
@@ -428,7 +655,7 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
         row = idx // 2
         x = grid_left + col * (cell_w + gap)
         y = grid_top - (row + 1) * cell_h - row * gap
-        c.setFillColor(colors.HexColor("#f1f1f1"))
+        c.setFillColor(colors.HexColor(PHOTO_CELL_BACKGROUND))
         c.rect(x, y, cell_w, cell_h, fill=1, stroke=0)
         if img:
             individual_scale, offset_x, offset_y, mode, custom_w, custom_h = image_configs[idx]
@@ -446,6 +673,9 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
                 offset_y=offset_y,
                 custom_w_pct=custom_w,
                 custom_h_pct=custom_h,
+                target_dpi=image_dpi,
+                shared=shared_images,
+                background=PHOTO_CELL_BACKGROUND,
             )
 
     # Rebajado band
@@ -477,20 +707,20 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
 
     c.setFont("Helvetica", 9)
     icons = [
-        ("Habitaciones", str(data.habitaciones), ASSETS_DIR / "dormitorio.png", colors.black),
-        ("Baños", str(data.banos), ASSETS_DIR / "aseo.png", colors.black),
-        ("Jardín", "✓" if data.jardin else "✗", ASSETS_DIR / "jardin.png", colors.HexColor("#16a34a") if data.jardin else colors.HexColor("#dc2626")),
-        ("Garaje", "✓" if data.garaje else "✗", ASSETS_DIR / "garaje.png", colors.HexColor("#16a34a") if data.garaje else colors.HexColor("#dc2626")),
-        ("Piscina", "✓" if data.piscina else "✗", ASSETS_DIR / "piscina.png", colors.HexColor("#16a34a") if data.piscina else colors.HexColor("#dc2626")),
+        ("Habitaciones", str(data.habitaciones), "dormitorio.png", colors.black),
+        ("Baños", str(data.banos), "aseo.png", colors.black),
+        ("Jardín", "✓" if data.jardin else "✗", "jardin.png", colors.HexColor("#16a34a") if data.jardin else colors.HexColor("#dc2626")),
+        ("Garaje", "✓" if data.garaje else "✗", "garaje.png", colors.HexColor("#16a34a") if data.garaje else colors.HexColor("#dc2626")),
+        ("Piscina", "✓" if data.piscina else "✗", "piscina.png", colors.HexColor("#16a34a") if data.piscina else colors.HexColor("#dc2626")),
     ]
     step = (PAGE_W - 20 * mm) / len(icons)
-    for i, (label, value, icon_path, value_color) in enumerate(icons):
+    for i, (label, value, icon_name, value_color) in enumerate(icons):
         cx = 10 * mm + step * (i + 0.5)
         icon_w = 9 * mm * layout["scale"]
         icon_h = 7 * mm * layout["scale"]
         icon_x = cx - icon_w / 2 - 4 * mm
         icon_y = icon_row_y + (icon_row_h - icon_h) / 2
-        _draw_feature_icon(c, icon_path, icon_x, icon_y, icon_w, icon_h)
+        _draw_feature_icon(c, icon_name, icon_x, icon_y, icon_w, icon_h)
         c.setFillColor(value_color)
         c.setFont("Helvetica-Bold", max(9, 11 * layout["scale"]))
         text_x = cx + 4 * mm
@@ -505,7 +735,7 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
     c.setFillColor(colors.HexColor("#f1f1f1"))
     c.rect(qr_x, qr_y, qr_size, qr_size, fill=1, stroke=0)
     if data.qr_imagen:
-        _draw_image_fit(c, data.qr_imagen, qr_x, qr_y, qr_size, qr_size)
+        _draw_image_fit(c, data.qr_imagen, qr_x, qr_y, qr_size, qr_size, shared=shared_images)
 
     desc_x = layout["desc_x"]
     desc_w = layout["desc_w"]
@@ -516,11 +746,10 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
     _draw_wrapped_lines(c, layout["desc_lines"], desc_x, desc_start_y, layout["line_h"], desc_max_h)
 
     # Energy rating + price
-    _draw_energy_image(c, energy_x, energy_img_y, energy_img_w, energy_img_h, data.energia)
-
-    c.setFont("Helvetica-Bold", 10)
-    c.setFillColor(colors.HexColor("#3fa63f"))
-    c.drawCentredString(energy_x + energy_img_w / 2, price_y + 8 * mm, "Precio")
+    if chrome:
+        _draw_energy_certificate(c, energy_x, energy_img_y, energy_img_w, energy_img_h)
+    _draw_energy_arrow(c, energy_x, energy_img_y, energy_img_w, energy_img_h, data.energia)
+    _draw_price_label(c, energy_x, energy_img_w, price_y)
 
     c.setFont("Helvetica-Bold", 80)
     c.setFillColor(_safe_color(data.color_precio, colors.HexColor("#b9cdb8")))
@@ -530,8 +759,32 @@ def generate_pdf(data: FlyerData, output_path: Union[str, BinaryIO]) -> None:
     c.setFillColor(colors.black)
     _draw_wrapped_text(c, LEGAL_TEXT, desc_x, footer_top, desc_w, 4.2 * mm, footer_max_h)
 
-    c.showPage()
-    c.save()
+
+# Pieces of the page chrome, identical for every flyer (the static layer).
+
+
+def _draw_page_base(c: canvas.Canvas, header_h: float) -> None:
+    # Background
+    c.setFillColor(colors.white)
+    c.rect(0, 0, PAGE_W, PAGE_H, fill=1, stroke=0)
+
+    # Top header bar
+    c.setFillColor(colors.HexColor("#213502"))
+    c.rect(0, PAGE_H - header_h, PAGE_W, header_h, fill=1, stroke=0)
+
+
+def _draw_header_logo(c: canvas.Canvas, header_h: float) -> None:
+    _draw_asset_fit(c, "logo_new_home.png", HEADER_LOGO_X, PAGE_H - header_h + 2 * mm, 48 * mm, header_h - 4 * mm)
+
+
+def _draw_energy_certificate(c: canvas.Canvas, x: float, y: float, w: float, h: float) -> None:
+    _draw_asset_fit(c, "certificado.png", x, y, w, h)
+
+
+def _draw_price_label(c: canvas.Canvas, energy_x: float, energy_w: float, price_y: float) -> None:
+    c.setFont("Helvetica-Bold", 10)
+    c.setFillColor(colors.HexColor("#3fa63f"))
+    c.drawCentredString(energy_x + energy_w / 2, price_y + 8 * mm, "Precio")
 
 
 def _draw_wrapped_text(
@@ -547,7 +800,7 @@ def _draw_wrapped_text(
         return
     font_name = c._fontname
     font_size = c._fontsize
-    lines = _wrap_text_to_width(c, text, font_name, font_size, w)
+    lines = wrap_text(text, font_name, font_size, w)
     _draw_wrapped_lines(c, lines, x, y, line_h, max_h)
 
 
@@ -570,94 +823,173 @@ def _draw_wrapped_lines(
         curr_y -= line_h
 
 
-def _measure_wrapped_text_height(
-    c: canvas.Canvas,
-    text: str,
-    font_name: str,
-    font_size: float,
-    max_width: float,
-    line_height: float,
-) -> float:
-    lines = _wrap_text_to_width(c, text, font_name, font_size, max_width)
-    return len(lines) * line_height
+LAYOUT_MIN_SCALE = 0.90
+LAYOUT_MAX_SCALE = 1.08
+LAYOUT_SCALE_STEP = 0.01
+DESC_FONT_MIN = 8.0
 
+# Wrapped lines per (text, font, size, width).
+_WRAP_CACHE: dict[tuple[str, str, float, float], tuple[str, ...]] = {}
+_WRAP_CACHE_MAX = 512
 
-def _wrap_text_to_width(
-    c: canvas.Canvas,
+
+def _wrap_text_cached(
     text: str,
     font_name: str,
     font_size: float,
     max_width: float,
 ) -> list[str]:
-    if not text:
-        return []
-
-    def split_long_word(word: str) -> list[str]:
-        chunks: list[str] = []
-        current = ""
-        for char in word:
-            probe = current + char
-            if c.stringWidth(probe, font_name, font_size) <= max_width or not current:
-                current = probe
-            else:
-                chunks.append(current)
-                current = char
-        if current:
-            chunks.append(current)
-        return chunks
-
-    lines: list[str] = []
-    paragraphs = str(text).replace("\r", "").split("\n")
-    for paragraph in paragraphs:
-        words = paragraph.split()
-        if not words:
-            lines.append("")
-            continue
-        current = ""
-        for word in words:
-            probe = word if not current else f"{current} {word}"
-            if c.stringWidth(probe, font_name, font_size) <= max_width:
-                current = probe
-                continue
-
-            if current:
-                lines.append(current)
-                current = ""
-
-            if c.stringWidth(word, font_name, font_size) <= max_width:
-                current = word
-            else:
-                chunks = split_long_word(word)
-                if chunks:
-                    lines.extend(chunks[:-1])
-                    current = chunks[-1]
-
-        if current:
-            lines.append(current)
-
-    return lines
-
-
-def _truncate_lines_to_count(
-    c: canvas.Canvas,
-    lines: list[str],
-    max_lines: int,
-    font_name: str,
+    key = (text, font_name, font_size, max_width)
+    lines = _WRAP_CACHE.get(key)
+    if lines is None:
+        if len(_WRAP_CACHE) >= _WRAP_CACHE_MAX:
+            _WRAP_CACHE.clear()
+        lines = tuple(wrap_text(text, font_name, font_size, max_width))
+        _WRAP_CACHE[key] = lines
+    return list(lines)
+
+
+def _layout_scale_range(start: float, end: float, step: float) -> list[float]:
+    values = []
+    current = start
+    while current >= end - 1e-9:
+        values.append(round(current, 2))
+        current -= step
+    return values
+
+
+def _compute_layout(
+    description: str,
+    available_height: float,
+    scale: float,
+    spacing_ratio: float,
     font_size: float,
-    max_width: float,
-) -> list[str]:
-    if max_lines <= 0:
-        return []
-    if len(lines) <= max_lines:
-        return lines
-
-    clipped = lines[:max_lines]
-    last = clipped[-1].rstrip()
-    ellipsis = "…"
-    while last and c.stringWidth(f"{last}{ellipsis}", font_name, font_size) > max_width:
-        last = last[:-1]
-    clipped[-1] = f"{last}{ellipsis}" if last else ellipsis
-    return clipped
+) -> dict:
+    top_gap = 6 * mm * spacing_ratio
+    grid_h = 110 * mm * scale
+    grid_w = PAGE_W - 20 * mm
+    grid_gap = 4 * mm
+    icon_row_h = 14 * mm * scale
+    grid_to_icons_gap = 12 * mm * spacing_ratio
+    icons_to_desc_gap = 10 * mm * spacing_ratio
+    qr_size = 30 * mm * scale
+    desc_x = 10 * mm + qr_size + 6 * mm
+    desc_w = PAGE_W - desc_x - 10 * mm
+    line_h = max(3.2 * mm, font_size * 1.3)
+    desc_lines = _wrap_text_cached(description, "Helvetica", font_size, desc_w)
+    desc_h = len(desc_lines) * line_h
+    desc_row_h = max(qr_size, desc_h + 2 * mm)
+    block_h = top_gap + grid_h + grid_to_icons_gap + icon_row_h + icons_to_desc_gap + desc_row_h
+    remaining = available_height - block_h
+    return {
+        "scale": scale,
+        "top_gap": top_gap,
+        "grid_h": grid_h,
+        "grid_w": grid_w,
+        "grid_gap": grid_gap,
+        "icon_row_h": icon_row_h,
+        "grid_to_icons_gap": grid_to_icons_gap,
+        "icons_to_desc_gap": icons_to_desc_gap,
+        "qr_size": qr_size,
+        "desc_x": desc_x,
+        "desc_w": desc_w,
+        "desc_font_size": font_size,
+        "line_h": line_h,
+        "desc_lines": desc_lines,
+        "desc_h": desc_h,
+        "desc_row_h": desc_row_h,
+        "block_h": block_h,
+        "remaining": remaining,
+    }
+
+
+def _first_fitting(candidates: list, fits: Callable[[Any], bool]) -> Optional[int]:
+    # Candidates run from largest to smallest and the block only shrinks along
+    # them (a smaller scale or font never needs more description lines), so
+    # the fitting ones form a suffix. The first candidate is the usual answer
+    # and is tried on its own; otherwise the boundary is bisected.
+    if not candidates:
+        return None
+    if fits(candidates[0]):
+        return 0
+    if not fits(candidates[-1]):
+        return None
+    lo, hi = 0, len(candidates) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if fits(candidates[mid]):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+
+def _solve_layout(
+    description: str,
+    font_size_setting: float,
+    available_height: float,
+    min_margin: float,
+) -> dict:
+    # Picks the largest block scale that leaves both margins, then retries
+    # with tighter spacing, then shrinks the description font, and as a last
+    # resort truncates the description. Same choice as scanning every
+    # candidate in order, with a handful of layout evaluations.
+    desc_font_size = _safe_description_font_size(font_size_setting)
+    if len(description) > 1000:
+        desc_font_size = max(DESC_FONT_MIN, desc_font_size - 1.0)
+
+    def layout_for(scale: float, spacing_ratio: float, font_size: float) -> dict:
+        return _compute_layout(description, available_height, scale, spacing_ratio, font_size)
+
+    def fits(layout_args: tuple[float, float, float]) -> bool:
+        return layout_for(*layout_args)["remaining"] >= 2 * min_margin
+
+    base_layout = layout_for(1.0, 1.0, desc_font_size)
+    prefer_scale_up = base_layout["remaining"] > 20 * mm
+    first_scales = _layout_scale_range(
+        LAYOUT_MAX_SCALE if prefer_scale_up else 1.0, LAYOUT_MIN_SCALE, LAYOUT_SCALE_STEP
+    )
+    font_sizes = []
+    font_size = desc_font_size
+    while font_size >= DESC_FONT_MIN:
+        font_sizes.append(font_size)
+        font_size -= 0.5
+
+    passes = [
+        [(scale, 1.0, desc_font_size) for scale in first_scales],
+        [(scale, 0.88, desc_font_size) for scale in _layout_scale_range(1.0, LAYOUT_MIN_SCALE, LAYOUT_SCALE_STEP)],
+        [(LAYOUT_MIN_SCALE, 0.82, size) for size in font_sizes],
+    ]
+    for candidates in passes:
+        index = _first_fitting(candidates, fits)
+        if index is not None:
+            return layout_for(*candidates[index])
+
+    layout = layout_for(LAYOUT_MIN_SCALE, 0.80, DESC_FONT_MIN)
+    fixed_part_h = (
+        layout["top_gap"]
+        + layout["grid_h"]
+        + layout["grid_to_icons_gap"]
+        + layout["icon_row_h"]
+        + layout["icons_to_desc_gap"]
+    )
+    max_desc_row_h = max(layout["qr_size"], available_height - fixed_part_h - 2 * min_margin)
+    max_desc_h = max(0.0, max_desc_row_h - 2 * mm)
+    max_lines = max(1, int(max_desc_h // layout["line_h"]))
+    truncated = truncate_lines(
+        layout["desc_lines"],
+        max_lines,
+        "Helvetica",
+        layout["desc_font_size"],
+        layout["desc_w"],
+    )
+    used_desc_h = len(truncated) * layout["line_h"]
+    layout["desc_lines"] = truncated
+    layout["desc_h"] = used_desc_h
+    layout["desc_row_h"] = max(layout["qr_size"], used_desc_h + 2 * mm)
+    layout["block_h"] = fixed_part_h + layout["desc_row_h"]
+    layout["remaining"] = available_height - layout["block_h"]
+    return layout
 
 
 def _draw_energy_label(c: canvas.Canvas, x: float, y: float, w: float, h: float, energia: str) -> None:
@@ -684,11 +1016,7 @@ def _draw_energy_label(c: canvas.Canvas, x: float, y: float, w: float, h: float,
         c.line(x + w + 10, arrow_y, x + w + 6, arrow_y - 3)
 
 
-def _draw_energy_image(c: canvas.Canvas, x: float, y: float, w: float, h: float, energia: str) -> None:
-    image_path = ASSETS_DIR / "certificado.png"
-    if image_path.exists():
-        _draw_image_fit(c, str(image_path), x, y, w, h)
-
+def _draw_energy_arrow(c: canvas.Canvas, x: float, y: float, w: float, h: float, energia: str) -> None:
     levels = ["A", "B", "C", "D", "E", "F", "G"]
     if energia and energia.upper() in levels:
         idx = levels.index(energia.upper())
@@ -773,9 +1101,8 @@ def _format_superscripts(value: str) -> str:
     return re.sub(r"m\s*\^?\s*2", "m²", value, flags=re.IGNORECASE)
 
 
-def _draw_feature_icon(c: canvas.Canvas, path: Path, x: float, y: float, w: float, h: float) -> None:
-    if path.exists():
-        _draw_image_fit(c, str(path), x, y, w, h)
+def _draw_feature_icon(c: canvas.Canvas, filename: str, x: float, y: float, w: float, h: float) -> None:
+    _draw_asset_fit(c, filename, x, y, w, h)
 
 
 def _draw_house_icon(c: canvas.Canvas, x: float, y: float) -> None:
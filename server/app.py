@@ -1,60 +1,208 @@
+import asyncio
+import hashlib
 import json
+import math
 import os
-import tempfile
-import hashlib
 import io
-from collections import OrderedDict
+import re
+import secrets
+import zipfile
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Any, Awaitable, Callable, Optional
 
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response
-import fitz
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from PIL import UnidentifiedImageError
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from starlette.formparsers import MultiPartException
+from PIL import Image, UnidentifiedImageError
+from reportlab.lib.pagesizes import A4
 
-from pdf_generator import FlyerData, generate_pdf
+from pdf_generator import FlyerData, load_static_assets
+from server.image_normalize import normalize_image
+from server.image_store import store_from_env
+from server.jobs import DONE, FAILED, Job, JobRegistry, JobsFull
+from server.metrics import CACHE_LOOKUPS, REGISTRY, Gauge, MetricsMiddleware, stage
+from server.profiling import RequestProfile
+from server.render_cache import cache_from_env, env_int
+from server.render_pool import (
+    IMAGE_SLOTS,
+    PREVIEW_DPI,
+    PREVIEW_FORMATS,
+    PREVIEW_MODE,
+    PREVIEW_QUALITY,
+    PreviewOptions,
+    RenderJob,
+    RenderQueueFull,
+    RenderedDocument,
+    SpooledOutput,
+    build_job,
+    fingerprint,
+    pool_from_env,
+    rasterize_pdf,
+    render_catalog,
+    render_layered_preview,
+    render_raster_preview,
+    render_pdf,
+    render_pdf_document,
+    render_preview,
+    render_tile,
+)
+from server.uploads import (
+    UPLOAD_CHUNK_BYTES,
+    IngestedUpload,
+    RequestSizeLimitMiddleware,
+    UploadBudget,
+    ingest_upload,
+    ingest_uploads,
+)
+from server.zip_stream import ZipStream
 
 ROOT_DIR = Path(__file__).resolve().parent.parent
 ASSETS_DIR = ROOT_DIR / "assets"
 CREDENTIALS_FILE = ROOT_DIR / "credentials.json"
+ADMIN_TOKEN = os.environ.get("NEWHOME_ADMIN_TOKEN", "")
+BATCH_MAX_FLYERS = env_int("NEWHOME_BATCH_MAX", 200)
+RESPONSE_CHUNK_BYTES = 256 * 1024
+PREVIEW_MIN_DPI = 24
+PREVIEW_MAX_DPI = 200
+PREVIEW_MIN_WIDTH = 120
+PREVIEW_MAX_WIDTH = math.floor(A4[0] * PREVIEW_MAX_DPI / 72)
+TILE_DPI = 300
+TILE_MAX_DPI = 600
+TILE_MAX_PIXELS = 2048 * 2048
+FLYER_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+
+RENDER_POOL = pool_from_env()
+IMAGE_STORE = store_from_env()
+JOBS = JobRegistry()
 
-app = FastAPI(title="NewHome API")
+REGISTRY.register(Gauge("newhome_render_pending", "Render pool calls running or waiting.", lambda: RENDER_POOL.pending))
+REGISTRY.register(Gauge("newhome_jobs_active", "Background jobs queued or running.", lambda: JOBS.active))
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_static_assets()
+    yield
+    JOBS.shutdown()
+    RENDER_POOL.shutdown()
+
+
+app = FastAPI(title="NewHome API", lifespan=lifespan)
+
+# Middleware added later wraps what was added before. The size limit sits
+# inside CORS so its 413s carry the CORS headers; metrics, added last, is
+# the outermost layer and also counts those rejections and CORS preflights.
+app.add_middleware(RequestSizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Flyer-Key", "X-Profile-Id"],
 )
+app.add_middleware(MetricsMiddleware)
 
 if ASSETS_DIR.exists():
     app.mount("/static", StaticFiles(directory=str(ASSETS_DIR)), name="assets")
 
-PREVIEW_CACHE: "OrderedDict[str, bytes]" = OrderedDict()
-PREVIEW_CACHE_MAX = 20
+# Rendered PDFs ("pdf:<key>") and preview images ("preview:<variant>:<key>")
+# share one cache, all keyed by the fingerprint of the normalized FlyerData.
+RENDER_CACHE = cache_from_env()
 
 
-def _cache_get(key: str) -> Optional[bytes]:
-    if key in PREVIEW_CACHE:
-        PREVIEW_CACHE.move_to_end(key)
-        return PREVIEW_CACHE[key]
-    return None
+async def _cache_get(key: str) -> Optional[bytes]:
+    if RENDER_CACHE.blocking:
+        data = await run_in_threadpool(RENDER_CACHE.get, key)
+    else:
+        data = RENDER_CACHE.get(key)
+    CACHE_LOOKUPS.inc(kind=key.partition(":")[0], result="miss" if data is None else "hit")
+    return data
 
 
-def _cache_set(key: str, data: bytes) -> None:
-    PREVIEW_CACHE[key] = data
-    PREVIEW_CACHE.move_to_end(key)
-    while len(PREVIEW_CACHE) > PREVIEW_CACHE_MAX:
-        PREVIEW_CACHE.popitem(last=False)
+async def _cache_set(key: str, data: bytes) -> None:
+    with stage("cache_write"):
+        if RENDER_CACHE.blocking:
+            await run_in_threadpool(RENDER_CACHE.set, key, data)
+        else:
+            RENDER_CACHE.set(key, data)
 
 
-def _hash_bytes(value: Optional[bytes]) -> Optional[str]:
-    if value is None:
+def _stored_image_ref(value: Optional[str]) -> Optional[str]:
+    image_id = (value or "").strip().lower()
+    if not image_id:
         return None
-    return hashlib.sha256(value).hexdigest()
+    if not IMAGE_STORE.contains(image_id):
+        raise HTTPException(status_code=404, detail="La imagen ya no está disponible. Vuelve a subirla.")
+    return image_id
+
+
+async def _slot_refs(
+    uploads: dict[str, Optional[IngestedUpload]], image_ids: dict[str, str]
+) -> dict[str, Optional[str]]:
+    # Files sent with the form go into the image store like /api/images
+    # uploads; a slot without one may reference a stored image by ID.
+    refs: dict[str, Optional[str]] = {}
+    for slot, upload in uploads.items():
+        if upload:
+            refs[slot] = await run_in_threadpool(_store_image, upload.data, upload.sha256)
+        else:
+            refs[slot] = _stored_image_ref(image_ids[slot])
+    return refs
+
+
+def _load_stored_image(image_id: Optional[str]) -> Optional[bytes]:
+    if image_id is None:
+        return None
+    data = IMAGE_STORE.get(image_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="La imagen ya no está disponible. Vuelve a subirla.")
+    return data
+
+
+def _load_stored_images(refs: dict[str, Optional[str]]) -> dict[str, Optional[bytes]]:
+    # Disk reads; call it through run_in_threadpool.
+    return {slot: _load_stored_image(ref) for slot, ref in refs.items()}
+
+
+def _document_response(document: RenderedDocument, media_type: str, headers: dict[str, str]) -> Response:
+    if document.data is not None:
+        return Response(content=document.data, media_type=media_type, headers=headers)
+    # Spilled to disk by the worker: unlink right away (the open handle keeps
+    # it readable, and nothing is left behind if the client goes away) and
+    # stream it in chunks.
+    spool = open(document.path, "rb")
+    os.unlink(document.path)
+
+    def chunks():
+        with spool:
+            while chunk := spool.read(RESPONSE_CHUNK_BYTES):
+                yield chunk
+
+    return StreamingResponse(
+        chunks(),
+        media_type=media_type,
+        headers={**headers, "Content-Length": str(document.size)},
+    )
+
+
+def _require_admin(token: Optional[str]) -> None:
+    if not ADMIN_TOKEN or not token or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Acceso restringido")
+
+
+def _request_profile(flag: Optional[str], token: Optional[str], endpoint: str) -> Optional[RequestProfile]:
+    # Admin only: ``X-Profile: 1`` runs the request's renders under the
+    # profiler, skipping the cached results that would leave nothing to see.
+    if not parse_bool(flag):
+        return None
+    _require_admin(token)
+    return RequestProfile(endpoint)
 
 
 def load_credentials() -> dict:
@@ -122,6 +270,194 @@ def parse_description_font_size(value: Optional[str], default: float = 9.0) -> f
     return max(8.0, min(14.0, numeric))
 
 
+def parse_preview_options(
+    dpi: Optional[str],
+    width: Optional[str],
+    image_format: Optional[str],
+    quality: Optional[str],
+    default_dpi: float = PREVIEW_DPI,
+    max_dpi: float = PREVIEW_MAX_DPI,
+) -> PreviewOptions:
+    # ``width`` in pixels wins over ``dpi``; it is turned into the resolution
+    # that makes the A4 page exactly that wide.
+    fmt = str(image_format or "png").strip().lower()
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if fmt not in PREVIEW_FORMATS:
+        fmt = "png"
+    try:
+        level = max(30, min(95, int(quality))) if quality else PREVIEW_QUALITY
+    except ValueError:
+        level = PREVIEW_QUALITY
+    resolution = float(default_dpi)
+    try:
+        if width:
+            pixels = max(PREVIEW_MIN_WIDTH, min(PREVIEW_MAX_WIDTH, int(width)))
+            resolution = math.floor(pixels * 72 / A4[0] * 100) / 100
+        elif dpi:
+            resolution = max(PREVIEW_MIN_DPI, min(max_dpi, float(dpi)))
+    except ValueError:
+        pass
+    return PreviewOptions(dpi=resolution, format=fmt, quality=level)
+
+
+# Defaults of the flyer form fields, also used for JSON flyer specs.
+FLYER_FIELD_DEFAULTS = {
+    "texto1": "",
+    "color_texto1": "#ffffff",
+    "texto_marca": "",
+    "color_texto_marca": "#ffffff",
+    "texto2": "",
+    "color_texto2": "#000000",
+    "texto3": "",
+    "color_texto3": "#000000",
+    "texto4": "REBAJADO",
+    "color_texto4": "#ffffff",
+    "rebajado": "true",
+    "habitaciones": 0,
+    "banos": 0,
+    "jardin": "false",
+    "garaje": "false",
+    "piscina": "false",
+    "borde_caracteristicas": "solid",
+    "color_borde_caracteristicas": "#111111",
+    "descripcion": "",
+    "color_descripcion": "#000000",
+    "descripcion_tamano": "9",
+    "precio": "",
+    "color_precio": "#b9cdb8",
+    "energia": "E",
+    "escala_imagenes": "0.93",
+    **{
+        f"imagen{i}_{name}": default
+        for i in range(1, 5)
+        for name, default in (
+            ("escala", "1"),
+            ("offset_x", "0"),
+            ("offset_y", "0"),
+            ("modo", "contain"),
+            ("custom_ancho", "100"),
+            ("custom_alto", "100"),
+        )
+    },
+}
+
+
+def flyer_from_fields(fields: dict[str, Any]) -> FlyerData:
+    # The one parser of flyer fields, for form posts and JSON specs alike;
+    # image slots are left empty.
+    values = dict(FLYER_FIELD_DEFAULTS)
+    values.update({name: value for name, value in fields.items() if name in values and value is not None})
+    text = {name: str(value) for name, value in values.items()}
+    images = {}
+    for i in range(1, 5):
+        images.update(
+            {
+                f"imagen{i}_escala": parse_scale(text[f"imagen{i}_escala"], 1.0),
+                f"imagen{i}_offset_x": parse_offset(text[f"imagen{i}_offset_x"]),
+                f"imagen{i}_offset_y": parse_offset(text[f"imagen{i}_offset_y"]),
+                f"imagen{i}_modo": parse_image_mode(text[f"imagen{i}_modo"]),
+                f"imagen{i}_custom_ancho": parse_dimension_percent(text[f"imagen{i}_custom_ancho"]),
+                f"imagen{i}_custom_alto": parse_dimension_percent(text[f"imagen{i}_custom_alto"]),
+            }
+        )
+    return FlyerData(
+        texto1=text["texto1"],
+        color_texto1=text["color_texto1"],
+        texto_marca=text["texto_marca"],
+        color_texto_marca=text["color_texto_marca"],
+        texto2=text["texto2"],
+        color_texto2=text["color_texto2"],
+        texto2_fondo=None,
+        texto3=text["texto3"],
+        color_texto3=text["color_texto3"],
+        texto4=text["texto4"],
+        color_texto4=text["color_texto4"],
+        rebajado=parse_bool(text["rebajado"], True),
+        habitaciones=int(values["habitaciones"]),
+        banos=int(values["banos"]),
+        jardin=parse_bool(text["jardin"]),
+        garaje=parse_bool(text["garaje"]),
+        piscina=parse_bool(text["piscina"]),
+        borde_caracteristicas=text["borde_caracteristicas"],
+        color_borde_caracteristicas=text["color_borde_caracteristicas"],
+        descripcion=text["descripcion"],
+        color_descripcion=text["color_descripcion"],
+        descripcion_tamano=parse_description_font_size(text["descripcion_tamano"]),
+        precio=text["precio"],
+        color_precio=text["color_precio"],
+        energia=text["energia"],
+        escala_imagenes=parse_scale(text["escala_imagenes"]),
+        imagen1=None,
+        imagen2=None,
+        imagen3=None,
+        imagen4=None,
+        qr_imagen=None,
+        **images,
+    )
+
+
+# Keys of an entry in a compact spec's ``images`` list and the form fields
+# they stand for (``imagenN_<field>``).
+SPEC_IMAGE_KEYS = {
+    "mode": "modo",
+    "scale": "escala",
+    "offset_x": "offset_x",
+    "offset_y": "offset_y",
+    "custom_w": "custom_ancho",
+    "custom_h": "custom_alto",
+}
+
+
+def spec_fields(spec: dict[str, Any]) -> dict[str, Any]:
+    # A compact spec carries the photos as ``images``, a list of up to four
+    # {ref, mode, scale, offset_x, offset_y, custom_w, custom_h} (or null for
+    # an empty slot); this turns it into the flat form fields.
+    images = spec.get("images")
+    if images is None:
+        return spec
+    if not isinstance(images, list) or len(images) > 4:
+        raise ValueError("images must be a list of at most four entries")
+    fields = {name: value for name, value in spec.items() if name != "images"}
+    for i, image in enumerate(images, start=1):
+        if image is None:
+            continue
+        if not isinstance(image, dict):
+            raise ValueError(f"images[{i - 1}] must be an object")
+        if image.get("ref"):
+            fields[f"imagen{i}_id"] = image["ref"]
+        for key, name in SPEC_IMAGE_KEYS.items():
+            if image.get(key) is not None:
+                fields[f"imagen{i}_{name}"] = image[key]
+    return fields
+
+
+def _verify_image(data: bytes) -> None:
+    if not data:
+        raise HTTPException(status_code=400, detail="La imagen está vacía.")
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+    except Exception:
+        raise HTTPException(status_code=400, detail="La imagen no es válida o está dañada. Usa JPG, PNG o WEBP.")
+
+
+def _store_image(data: bytes, image_id: Optional[str] = None) -> str:
+    # Stores an upload normalized for rendering, under the hash of the bytes
+    # as sent, so the same file sent again is neither decoded nor converted
+    # twice. Blocking: called from a worker thread.
+    image_id = image_id or hashlib.sha256(data).hexdigest()
+    if IMAGE_STORE.contains(image_id):
+        return image_id
+    _verify_image(data)
+    try:
+        normalized = normalize_image(data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="La imagen no es válida o está dañada. Usa JPG, PNG o WEBP.")
+    with stage("image_store_write"):
+        IMAGE_STORE.put(normalized, image_id)
+    return image_id
+
+
 @app.post("/api/login")
 async def login(username: str = Form(...), password: str = Form(...)):
     creds = load_credentials()
@@ -130,381 +466,563 @@ async def login(username: str = Form(...), password: str = Form(...)):
     raise HTTPException(status_code=401, detail="Credenciales inválidas")
 
 
+@app.get("/api/admin/cache")
+async def cache_stats(x_admin_token: Optional[str] = Header(None)):
+    _require_admin(x_admin_token)
+    return {"render": RENDER_CACHE.stats(), "images": IMAGE_STORE.stats(), "jobs": JOBS.stats()}
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format. Counters are per process: with several server
+    # processes, each one has to be scraped.
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.post("/api/images")
+async def upload_image(imagen: UploadFile = File(...)):
+    upload = await ingest_upload(imagen, UploadBudget())
+    if upload is None:
+        raise HTTPException(status_code=400, detail="La imagen está vacía.")
+    image_id = await run_in_threadpool(_store_image, upload.data, upload.sha256)
+    return {"id": image_id, "size": len(upload.data)}
+
+
+ImageLoader = Callable[[], dict[str, Optional[bytes]]]
+
+
+async def _pdf_response(
+    data: FlyerData,
+    image_hashes: dict[str, Optional[str]],
+    load_images: ImageLoader,
+    profile: Optional[RequestProfile] = None,
+) -> Response:
+    # Shared by the form and spec endpoints. Images are only loaded on a
+    # cache miss.
+    headers = {"Content-Disposition": "attachment; filename=flyer.pdf"}
+    cache_key = fingerprint(data, image_hashes)
+    cached_pdf = None if profile else await _cache_get(f"pdf:{cache_key}")
+    if cached_pdf is not None:
+        return Response(content=cached_pdf, media_type="application/pdf", headers=headers)
+
+    job = build_job(data, await run_in_threadpool(load_images))
+    run = profile.runner(RENDER_POOL.run) if profile else RENDER_POOL.run
+    try:
+        document = await run(render_pdf_document, job)
+    except RenderQueueFull:
+        raise HTTPException(status_code=503, detail="El servidor está ocupado. Inténtalo de nuevo en unos segundos.")
+    except UnidentifiedImageError:
+        raise HTTPException(status_code=400, detail="Alguna imagen no es válida o está dañada. Usa JPG, PNG o WEBP.")
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Error interno al generar el PDF: {exc}")
+
+    if document.data is not None:
+        await _cache_set(f"pdf:{cache_key}", document.data)
+    if profile:
+        headers["X-Profile-Id"] = await run_in_threadpool(profile.save)
+    return _document_response(document, "application/pdf", headers)
+
+
+async def _read_flyer_spec(request: Request) -> tuple[dict[str, Any], FlyerData, dict[str, Optional[str]]]:
+    # One JSON document for a single flyer: the form fields by name, photos
+    # in ``images`` and the other images as ``qr_imagen_id`` and
+    # ``texto2_fondo_id``, all referring to /api/images uploads.
+    try:
+        spec = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="La ficha debe enviarse en JSON.")
+    try:
+        if not isinstance(spec, dict):
+            raise TypeError("spec must be an object")
+        spec = spec_fields(spec)
+        data = flyer_from_fields(spec)
+    except (TypeError, ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="La ficha no es válida.")
+    refs = {slot: _stored_image_ref(str(spec.get(f"{slot}_id") or "")) for slot in IMAGE_SLOTS}
+    return spec, data, refs
+
+
+async def _read_flyer_form(request: Request) -> tuple[dict[str, str], FlyerData, dict[str, Optional[str]]]:
+    # The multipart form of /api/pdf and /api/preview: the same fields as a
+    # JSON spec, parsed by flyer_from_fields, plus a file or an ``<slot>_id``
+    # per image slot. Empty fields count as absent, as they always have for
+    # form posts.
+    try:
+        form = await request.form()
+    except MultiPartException:
+        raise HTTPException(status_code=400, detail="La ficha no es válida.")
+    try:
+        fields = {name: value for name, value in form.items() if isinstance(value, str) and value != ""}
+        try:
+            data = flyer_from_fields(fields)
+        except (TypeError, ValueError, OverflowError):
+            raise HTTPException(status_code=400, detail="La ficha no es válida.")
+        files = {slot: form.get(slot) for slot in IMAGE_SLOTS}
+        uploads = await ingest_uploads(
+            {slot: upload if isinstance(upload, StarletteUploadFile) else None for slot, upload in files.items()}
+        )
+    finally:
+        await form.close()
+    refs = await _slot_refs(uploads, {slot: fields.get(f"{slot}_id", "") for slot in IMAGE_SLOTS})
+    return fields, data, refs
+
+
+def _stored_images(refs: dict[str, Optional[str]]) -> ImageLoader:
+    return lambda: _load_stored_images(refs)
+
+
 @app.post("/api/pdf")
 async def create_pdf(
-    texto1: str = Form(""),
-    color_texto1: str = Form("#ffffff"),
-    texto_marca: str = Form(""),
-    color_texto_marca: str = Form("#ffffff"),
-    texto2: str = Form(""),
-    color_texto2: str = Form("#000000"),
-    texto2_fondo: Optional[UploadFile] = File(None),
-    texto3: str = Form(""),
-    color_texto3: str = Form("#000000"),
-    texto4: str = Form("REBAJADO"),
-    color_texto4: str = Form("#ffffff"),
-    rebajado: str = Form("true"),
-    habitaciones: int = Form(0),
-    banos: int = Form(0),
-    jardin: str = Form("false"),
-    garaje: str = Form("false"),
-    piscina: str = Form("false"),
-    borde_caracteristicas: str = Form("solid"),
-    color_borde_caracteristicas: str = Form("#111111"),
-    descripcion: str = Form(""),
-    color_descripcion: str = Form("#000000"),
-    descripcion_tamano: str = Form("9"),
-    precio: str = Form(""),
-    color_precio: str = Form("#b9cdb8"),
-    energia: str = Form("E"),
-    escala_imagenes: str = Form("0.93"),
-    imagen1_escala: str = Form("1"),
-    imagen1_offset_x: str = Form("0"),
-    imagen1_offset_y: str = Form("0"),
-    imagen1_modo: str = Form("contain"),
-    imagen1_custom_ancho: str = Form("100"),
-    imagen1_custom_alto: str = Form("100"),
-    imagen2_escala: str = Form("1"),
-    imagen2_offset_x: str = Form("0"),
-    imagen2_offset_y: str = Form("0"),
-    imagen2_modo: str = Form("contain"),
-    imagen2_custom_ancho: str = Form("100"),
-    imagen2_custom_alto: str = Form("100"),
-    imagen3_escala: str = Form("1"),
-    imagen3_offset_x: str = Form("0"),
-    imagen3_offset_y: str = Form("0"),
-    imagen3_modo: str = Form("contain"),
-    imagen3_custom_ancho: str = Form("100"),
-    imagen3_custom_alto: str = Form("100"),
-    imagen4_escala: str = Form("1"),
-    imagen4_offset_x: str = Form("0"),
-    imagen4_offset_y: str = Form("0"),
-    imagen4_modo: str = Form("contain"),
-    imagen4_custom_ancho: str = Form("100"),
-    imagen4_custom_alto: str = Form("100"),
-    imagen1: Optional[UploadFile] = File(None),
-    imagen2: Optional[UploadFile] = File(None),
-    imagen3: Optional[UploadFile] = File(None),
-    imagen4: Optional[UploadFile] = File(None),
-    qr_imagen: Optional[UploadFile] = File(None),
+    form: tuple[dict[str, str], FlyerData, dict[str, Optional[str]]] = Depends(_read_flyer_form),
+    x_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
 ):
-    tmp_dir = Path(tempfile.mkdtemp(prefix="newhome_"))
+    profile = _request_profile(x_profile, x_admin_token, "pdf")
+    _, data, refs = form
+    return await _pdf_response(data, refs, _stored_images(refs), profile)
 
-    async def read_upload(upload: Optional[UploadFile]) -> Optional[bytes]:
-        if not upload:
-            return None
-        return await upload.read()
 
-    def save_upload_bytes(data: Optional[bytes], filename: Optional[str]) -> Optional[str]:
-        if not data:
-            return None
-        suffix = Path(filename or "upload").suffix or ".png"
-        tmp_path = tmp_dir / f"{next(tempfile._get_candidate_names())}{suffix}"
-        with tmp_path.open("wb") as f:
-            f.write(data)
-        return str(tmp_path)
-
-    imagen1_bytes = await read_upload(imagen1)
-    imagen2_bytes = await read_upload(imagen2)
-    imagen3_bytes = await read_upload(imagen3)
-    imagen4_bytes = await read_upload(imagen4)
-    qr_bytes = await read_upload(qr_imagen)
-    fondo_bytes = await read_upload(texto2_fondo)
-
-    data = FlyerData(
-        texto1=texto1,
-        color_texto1=color_texto1,
-        texto_marca=texto_marca,
-        color_texto_marca=color_texto_marca,
-        texto2=texto2,
-        color_texto2=color_texto2,
-        texto2_fondo=save_upload_bytes(fondo_bytes, getattr(texto2_fondo, "filename", None)),
-        texto3=texto3,
-        color_texto3=color_texto3,
-        texto4=texto4,
-        color_texto4=color_texto4,
-        rebajado=parse_bool(rebajado, True),
-        habitaciones=int(habitaciones),
-        banos=int(banos),
-        jardin=parse_bool(jardin),
-        garaje=parse_bool(garaje),
-        piscina=parse_bool(piscina),
-        borde_caracteristicas=borde_caracteristicas,
-        color_borde_caracteristicas=color_borde_caracteristicas,
-        descripcion=descripcion,
-        color_descripcion=color_descripcion,
-        descripcion_tamano=parse_description_font_size(descripcion_tamano),
-        precio=precio,
-        color_precio=color_precio,
-        energia=energia,
-        escala_imagenes=parse_scale(escala_imagenes),
-        imagen1_escala=parse_scale(imagen1_escala, 1.0),
-        imagen1_offset_x=parse_offset(imagen1_offset_x),
-        imagen1_offset_y=parse_offset(imagen1_offset_y),
-        imagen1_modo=parse_image_mode(imagen1_modo),
-        imagen1_custom_ancho=parse_dimension_percent(imagen1_custom_ancho),
-        imagen1_custom_alto=parse_dimension_percent(imagen1_custom_alto),
-        imagen2_escala=parse_scale(imagen2_escala, 1.0),
-        imagen2_offset_x=parse_offset(imagen2_offset_x),
-        imagen2_offset_y=parse_offset(imagen2_offset_y),
-        imagen2_modo=parse_image_mode(imagen2_modo),
-        imagen2_custom_ancho=parse_dimension_percent(imagen2_custom_ancho),
-        imagen2_custom_alto=parse_dimension_percent(imagen2_custom_alto),
-        imagen3_escala=parse_scale(imagen3_escala, 1.0),
-        imagen3_offset_x=parse_offset(imagen3_offset_x),
-        imagen3_offset_y=parse_offset(imagen3_offset_y),
-        imagen3_modo=parse_image_mode(imagen3_modo),
-        imagen3_custom_ancho=parse_dimension_percent(imagen3_custom_ancho),
-        imagen3_custom_alto=parse_dimension_percent(imagen3_custom_alto),
-        imagen4_escala=parse_scale(imagen4_escala, 1.0),
-        imagen4_offset_x=parse_offset(imagen4_offset_x),
-        imagen4_offset_y=parse_offset(imagen4_offset_y),
-        imagen4_modo=parse_image_mode(imagen4_modo),
-        imagen4_custom_ancho=parse_dimension_percent(imagen4_custom_ancho),
-        imagen4_custom_alto=parse_dimension_percent(imagen4_custom_alto),
-        imagen1=save_upload_bytes(imagen1_bytes, getattr(imagen1, "filename", None)),
-        imagen2=save_upload_bytes(imagen2_bytes, getattr(imagen2, "filename", None)),
-        imagen3=save_upload_bytes(imagen3_bytes, getattr(imagen3, "filename", None)),
-        imagen4=save_upload_bytes(imagen4_bytes, getattr(imagen4, "filename", None)),
-        qr_imagen=save_upload_bytes(qr_bytes, getattr(qr_imagen, "filename", None)),
+@app.post("/api/pdf/spec")
+async def create_pdf_from_spec(
+    request: Request,
+    x_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+):
+    profile = _request_profile(x_profile, x_admin_token, "pdf")
+    _, data, refs = await _read_flyer_spec(request)
+    return await _pdf_response(data, refs, _stored_images(refs), profile)
+
+
+def _batch_entry_name(value: Any, index: int, used: set[str]) -> str:
+    stem = re.sub(r"[^\w.-]+", "_", str(value or "")).strip("._")
+    stem = re.sub(r"\.pdf$", "", stem, flags=re.IGNORECASE)[:80] or f"flyer_{index:03d}"
+    name = stem
+    suffix = 2
+    while name in used:
+        name = f"{stem}_{suffix}"
+        suffix += 1
+    used.add(name)
+    return name
+
+
+def _ingest_archive_images(archive: Any, names: set[str]) -> dict[str, str]:
+    # Moves the images the specs reference out of the uploaded ZIP into the
+    # image store, one at a time, so the batch only carries their IDs. The
+    # request cap only counts compressed bytes, so the inflated images get
+    # their own budget: the sizes declared in the archive are checked first,
+    # and reading stops at the limit whatever the headers claim.
+    image_ids: dict[str, str] = {}
+    budget = UploadBudget()
+    try:
+        with zipfile.ZipFile(archive) as zf:
+            for name in sorted(names):
+                try:
+                    info = zf.getinfo(name)
+                except KeyError:
+                    raise HTTPException(status_code=400, detail=f"La imagen {name} no está en el archivo.")
+                budget.check_file(info.file_size)
+                chunks: list[bytes] = []
+                total = 0
+                with zf.open(info) as entry:
+                    while chunk := entry.read(UPLOAD_CHUNK_BYTES):
+                        budget.consume(total, len(chunk))
+                        total += len(chunk)
+                        chunks.append(chunk)
+                image_ids[name] = _store_image(b"".join(chunks))
+    except zipfile.BadZipFile:
+        raise HTTPException(status_code=400, detail="El archivo de imágenes no es un ZIP válido.")
+    return image_ids
+
+
+async def _read_batch_request(request: Request) -> list[tuple[str, FlyerData, dict[str, Optional[str]]]]:
+    # Specs come as a JSON body ({"flyers": [...]} or a bare list) referencing
+    # stored images by ``<slot>_id``, or as multipart with the same JSON in
+    # ``specs`` plus an ``archivo`` ZIP whose paths the specs give in ``<slot>``.
+    archive = None
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            payload = json.loads(str(form.get("specs") or "[]"))
+            archive = form.get("archivo")
+        else:
+            payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Las fichas deben enviarse en JSON.")
+    specs = payload.get("flyers") if isinstance(payload, dict) else payload
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        raise HTTPException(status_code=400, detail="Envía una lista de fichas.")
+    if len(specs) > BATCH_MAX_FLYERS:
+        raise HTTPException(status_code=413, detail=f"Como máximo {BATCH_MAX_FLYERS} folletos por lote.")
+
+    archive_names = {
+        str(spec[slot]) for spec in specs for slot in IMAGE_SLOTS if isinstance(spec.get(slot), str) and spec[slot]
+    }
+    archive_ids: dict[str, str] = {}
+    if archive_names:
+        if not hasattr(archive, "file"):
+            raise HTTPException(status_code=400, detail="Falta el archivo con las imágenes.")
+        archive_ids = await run_in_threadpool(_ingest_archive_images, archive.file, archive_names)
+
+    items = []
+    used_names: set[str] = set()
+    for index, spec in enumerate(specs, start=1):
+        try:
+            spec = spec_fields(spec)
+            data = flyer_from_fields(spec)
+        except (TypeError, ValueError, OverflowError):
+            raise HTTPException(status_code=400, detail=f"La ficha {index} no es válida.")
+        refs = {}
+        for slot in IMAGE_SLOTS:
+            archive_name = spec.get(slot)
+            if isinstance(archive_name, str) and archive_name:
+                refs[slot] = archive_ids[archive_name]
+            else:
+                refs[slot] = _stored_image_ref(str(spec.get(f"{slot}_id") or ""))
+        name = _batch_entry_name(spec.get("nombre"), index, used_names)
+        items.append((name, data, refs))
+    return items
+
+
+async def _run_when_free(fn: Callable[..., Any], *args: Any) -> Any:
+    # Batches and background jobs wait for room in the pool instead of
+    # failing with 503 like an interactive request.
+    while True:
+        try:
+            return await RENDER_POOL.run(fn, *args)
+        except RenderQueueFull:
+            await asyncio.sleep(0.2)
+
+
+def _render_error_message(exc: Exception) -> str:
+    if isinstance(exc, HTTPException):
+        return exc.detail
+    if isinstance(exc, UnidentifiedImageError):
+        return "Alguna imagen no es válida o está dañada. Usa JPG, PNG o WEBP."
+    return f"Error interno al generar el PDF: {exc}"
+
+
+async def _render_batch_item(data: FlyerData, refs: dict[str, Optional[str]]) -> bytes:
+    cache_key = fingerprint(data, refs)
+    cached_pdf = await _cache_get(f"pdf:{cache_key}")
+    if cached_pdf is not None:
+        return cached_pdf
+    job = build_job(data, await run_in_threadpool(_load_stored_images, refs))
+    pdf_bytes = await _run_when_free(render_pdf, job)
+    await _cache_set(f"pdf:{cache_key}", pdf_bytes)
+    return pdf_bytes
+
+
+async def _stream_batch(
+    items: list[tuple[str, FlyerData, dict[str, Optional[str]]]],
+    on_entry: Optional[Callable[[], None]] = None,
+):
+    # At most one render per worker is in flight; each PDF goes into the ZIP
+    # (and out to the client) as soon as it is done, in completion order, so
+    # memory does not grow with the size of the batch. ``on_entry`` is called
+    # after every entry, for progress reporting.
+    zip_stream = ZipStream()
+    remaining = iter(items)
+    in_flight: dict[asyncio.Task, str] = {}
+    try:
+        while True:
+            while len(in_flight) < RENDER_POOL.workers:
+                item = next(remaining, None)
+                if item is None:
+                    break
+                name, data, refs = item
+                in_flight[asyncio.ensure_future(_render_batch_item(data, refs))] = name
+            if not in_flight:
+                break
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = in_flight.pop(task)
+                try:
+                    pdf_bytes = task.result()
+                except Exception as exc:
+                    # The response is already under way; the failure is
+                    # reported inside the archive next to the other flyers.
+                    message = _render_error_message(exc)
+                    yield zip_stream.add(f"{name}.error.txt", message.encode("utf-8"))
+                else:
+                    yield zip_stream.add(f"{name}.pdf", pdf_bytes)
+                if on_entry is not None:
+                    on_entry()
+        yield zip_stream.close()
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+@app.post("/api/pdf/batch")
+async def create_pdf_batch(request: Request):
+    items = await _read_batch_request(request)
+    return StreamingResponse(
+        _stream_batch(items),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=flyers.zip"},
     )
 
-    pdf_buffer = io.BytesIO()
+
+def _catalog_jobs(items: list[tuple[str, FlyerData, dict[str, Optional[str]]]]) -> list[RenderJob]:
+    # Each stored image is loaded once, however many flyers use it.
+    images: dict[str, bytes] = {}
+
+    def load_image(ref: Optional[str]) -> Optional[bytes]:
+        if ref is None:
+            return None
+        if ref not in images:
+            images[ref] = _load_stored_image(ref)
+        return images[ref]
+
+    return [build_job(data, {slot: load_image(ref) for slot, ref in refs.items()}) for _, data, refs in items]
+
+
+@app.post("/api/pdf/catalog")
+async def create_pdf_catalog(request: Request):
+    # Same specs as /api/pdf/batch, rendered as one PDF with a page per flyer.
+    items = await _read_batch_request(request)
+    jobs = await run_in_threadpool(_catalog_jobs, items)
     try:
-        generate_pdf(data, pdf_buffer)
+        document = await RENDER_POOL.run(render_catalog, jobs)
+    except RenderQueueFull:
+        raise HTTPException(status_code=503, detail="El servidor está ocupado. Inténtalo de nuevo en unos segundos.")
     except UnidentifiedImageError:
         raise HTTPException(status_code=400, detail="Alguna imagen no es válida o está dañada. Usa JPG, PNG o WEBP.")
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Error interno al generar el PDF: {exc}")
+    return _document_response(document, "application/pdf", {"Content-Disposition": "attachment; filename=catalogo.pdf"})
+
+
+async def _render_preview_image(
+    cache_key: str,
+    job: RenderJob,
+    options: PreviewOptions,
+    run: Callable[..., Awaitable[Any]],
+    reuse_pdf: bool = True,
+) -> bytes:
+    # A state that was already exported only needs rasterizing; otherwise the
+    # PDF rendered for the preview is kept so a following download is a hit.
+    # Layered previews trade that for a cheaper render of the changing parts.
+    cached_pdf = await _cache_get(f"pdf:{cache_key}") if reuse_pdf else None
+    if cached_pdf is not None:
+        image_bytes = await run(rasterize_pdf, cached_pdf, options)
+    elif PREVIEW_MODE == "layered":
+        image_bytes = await run(render_layered_preview, job, options)
+    elif PREVIEW_MODE == "raster":
+        image_bytes = await run(render_raster_preview, job, options)
+    else:
+        pdf_bytes, image_bytes = await run(render_preview, job, options)
+        await _cache_set(f"pdf:{cache_key}", pdf_bytes)
+    await _cache_set(f"preview:{options.variant}:{cache_key}", image_bytes)
+    return image_bytes
+
 
-    pdf_buffer.seek(0)
-    return Response(content=pdf_buffer.getvalue(), media_type="application/pdf", headers={"Content-Disposition": "attachment; filename=flyer.pdf"})
+async def _preview_response(
+    data: FlyerData,
+    image_hashes: dict[str, Optional[str]],
+    load_images: ImageLoader,
+    options: PreviewOptions,
+    profile: Optional[RequestProfile] = None,
+) -> Response:
+    cache_key = fingerprint(data, image_hashes)
+    # The key lets the client ask for zoom tiles of this state.
+    headers = {"X-Flyer-Key": cache_key}
+    cached = None if profile else await _cache_get(f"preview:{options.variant}:{cache_key}")
+    if cached is not None:
+        return Response(content=cached, media_type=options.media_type, headers=headers)
+
+    job = build_job(data, await run_in_threadpool(load_images))
+    run = profile.runner(RENDER_POOL.run) if profile else RENDER_POOL.run
+    try:
+        image_bytes = await _render_preview_image(cache_key, job, options, run, reuse_pdf=profile is None)
+    except RenderQueueFull:
+        raise HTTPException(status_code=503, detail="El servidor está ocupado. Inténtalo de nuevo en unos segundos.")
+    if profile:
+        headers["X-Profile-Id"] = await run_in_threadpool(profile.save)
+    return Response(content=image_bytes, media_type=options.media_type, headers=headers)
 
 
 @app.post("/api/preview")
 async def create_preview(
-    texto1: str = Form(""),
-    color_texto1: str = Form("#ffffff"),
-    texto_marca: str = Form(""),
-    color_texto_marca: str = Form("#ffffff"),
-    texto2: str = Form(""),
-    color_texto2: str = Form("#000000"),
-    texto2_fondo: Optional[UploadFile] = File(None),
-    texto3: str = Form(""),
-    color_texto3: str = Form("#000000"),
-    texto4: str = Form("REBAJADO"),
-    color_texto4: str = Form("#ffffff"),
-    rebajado: str = Form("true"),
-    habitaciones: int = Form(0),
-    banos: int = Form(0),
-    jardin: str = Form("false"),
-    garaje: str = Form("false"),
-    piscina: str = Form("false"),
-    borde_caracteristicas: str = Form("solid"),
-    color_borde_caracteristicas: str = Form("#111111"),
-    descripcion: str = Form(""),
-    color_descripcion: str = Form("#000000"),
-    descripcion_tamano: str = Form("9"),
-    precio: str = Form(""),
-    color_precio: str = Form("#b9cdb8"),
-    energia: str = Form("E"),
-    escala_imagenes: str = Form("0.93"),
-    imagen1_escala: str = Form("1"),
-    imagen1_offset_x: str = Form("0"),
-    imagen1_offset_y: str = Form("0"),
-    imagen1_modo: str = Form("contain"),
-    imagen1_custom_ancho: str = Form("100"),
-    imagen1_custom_alto: str = Form("100"),
-    imagen2_escala: str = Form("1"),
-    imagen2_offset_x: str = Form("0"),
-    imagen2_offset_y: str = Form("0"),
-    imagen2_modo: str = Form("contain"),
-    imagen2_custom_ancho: str = Form("100"),
-    imagen2_custom_alto: str = Form("100"),
-    imagen3_escala: str = Form("1"),
-    imagen3_offset_x: str = Form("0"),
-    imagen3_offset_y: str = Form("0"),
-    imagen3_modo: str = Form("contain"),
-    imagen3_custom_ancho: str = Form("100"),
-    imagen3_custom_alto: str = Form("100"),
-    imagen4_escala: str = Form("1"),
-    imagen4_offset_x: str = Form("0"),
-    imagen4_offset_y: str = Form("0"),
-    imagen4_modo: str = Form("contain"),
-    imagen4_custom_ancho: str = Form("100"),
-    imagen4_custom_alto: str = Form("100"),
-    imagen1: Optional[UploadFile] = File(None),
-    imagen2: Optional[UploadFile] = File(None),
-    imagen3: Optional[UploadFile] = File(None),
-    imagen4: Optional[UploadFile] = File(None),
-    qr_imagen: Optional[UploadFile] = File(None),
+    form: tuple[dict[str, str], FlyerData, dict[str, Optional[str]]] = Depends(_read_flyer_form),
+    x_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
 ):
-    async def read_upload(upload: Optional[UploadFile]) -> Optional[bytes]:
-        if not upload:
-            return None
-        return await upload.read()
+    profile = _request_profile(x_profile, x_admin_token, "preview")
+    fields, data, refs = form
+    options = parse_preview_options(fields.get("dpi"), fields.get("ancho"), fields.get("formato"), fields.get("calidad"))
+    return await _preview_response(data, refs, _stored_images(refs), options, profile)
 
-    imagen1_bytes = await read_upload(imagen1)
-    imagen2_bytes = await read_upload(imagen2)
-    imagen3_bytes = await read_upload(imagen3)
-    imagen4_bytes = await read_upload(imagen4)
-    qr_bytes = await read_upload(qr_imagen)
-    fondo_bytes = await read_upload(texto2_fondo)
 
-    cache_key = hashlib.sha256(
-        json.dumps(
-            {
-                "form": {
-                    "texto1": texto1,
-                    "color_texto1": color_texto1,
-                    "texto_marca": texto_marca,
-                    "color_texto_marca": color_texto_marca,
-                    "texto2": texto2,
-                    "color_texto2": color_texto2,
-                    "texto3": texto3,
-                    "color_texto3": color_texto3,
-                    "texto4": texto4,
-                    "color_texto4": color_texto4,
-                    "rebajado": rebajado,
-                    "habitaciones": int(habitaciones),
-                    "banos": int(banos),
-                    "jardin": jardin,
-                    "garaje": garaje,
-                    "piscina": piscina,
-                    "borde_caracteristicas": borde_caracteristicas,
-                    "color_borde_caracteristicas": color_borde_caracteristicas,
-                    "descripcion": descripcion,
-                    "color_descripcion": color_descripcion,
-                    "descripcion_tamano": parse_description_font_size(descripcion_tamano),
-                    "precio": precio,
-                    "color_precio": color_precio,
-                    "energia": energia,
-                    "escala_imagenes": parse_scale(escala_imagenes),
-                    "imagen1_escala": parse_scale(imagen1_escala, 1.0),
-                    "imagen1_offset_x": parse_offset(imagen1_offset_x),
-                    "imagen1_offset_y": parse_offset(imagen1_offset_y),
-                    "imagen1_modo": parse_image_mode(imagen1_modo),
-                    "imagen1_custom_ancho": parse_dimension_percent(imagen1_custom_ancho),
-                    "imagen1_custom_alto": parse_dimension_percent(imagen1_custom_alto),
-                    "imagen2_escala": parse_scale(imagen2_escala, 1.0),
-                    "imagen2_offset_x": parse_offset(imagen2_offset_x),
-                    "imagen2_offset_y": parse_offset(imagen2_offset_y),
-                    "imagen2_modo": parse_image_mode(imagen2_modo),
-                    "imagen2_custom_ancho": parse_dimension_percent(imagen2_custom_ancho),
-                    "imagen2_custom_alto": parse_dimension_percent(imagen2_custom_alto),
-                    "imagen3_escala": parse_scale(imagen3_escala, 1.0),
-                    "imagen3_offset_x": parse_offset(imagen3_offset_x),
-                    "imagen3_offset_y": parse_offset(imagen3_offset_y),
-                    "imagen3_modo": parse_image_mode(imagen3_modo),
-                    "imagen3_custom_ancho": parse_dimension_percent(imagen3_custom_ancho),
-                    "imagen3_custom_alto": parse_dimension_percent(imagen3_custom_alto),
-                    "imagen4_escala": parse_scale(imagen4_escala, 1.0),
-                    "imagen4_offset_x": parse_offset(imagen4_offset_x),
-                    "imagen4_offset_y": parse_offset(imagen4_offset_y),
-                    "imagen4_modo": parse_image_mode(imagen4_modo),
-                    "imagen4_custom_ancho": parse_dimension_percent(imagen4_custom_ancho),
-                    "imagen4_custom_alto": parse_dimension_percent(imagen4_custom_alto),
-                },
-                "files": {
-                    "imagen1": _hash_bytes(imagen1_bytes),
-                    "imagen2": _hash_bytes(imagen2_bytes),
-                    "imagen3": _hash_bytes(imagen3_bytes),
-                    "imagen4": _hash_bytes(imagen4_bytes),
-                    "qr_imagen": _hash_bytes(qr_bytes),
-                    "texto2_fondo": _hash_bytes(fondo_bytes),
-                },
-            },
-            sort_keys=True,
-        ).encode("utf-8")
-    ).hexdigest()
-
-    cached = _cache_get(cache_key)
+@app.post("/api/preview/spec")
+async def create_preview_from_spec(
+    request: Request,
+    x_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+):
+    # Same spec as /api/pdf/spec; ``dpi``, ``ancho``, ``formato`` and
+    # ``calidad`` work as in the form.
+    profile = _request_profile(x_profile, x_admin_token, "preview")
+    spec, data, refs = await _read_flyer_spec(request)
+    try:
+        options = parse_preview_options(spec.get("dpi"), spec.get("ancho"), spec.get("formato"), spec.get("calidad"))
+    except TypeError:
+        raise HTTPException(status_code=400, detail="La ficha no es válida.")
+    return await _preview_response(data, refs, _stored_images(refs), options, profile)
+
+
+@app.get("/api/preview/{flyer_key}/tile")
+async def preview_tile(
+    flyer_key: str,
+    x: float = 0.0,
+    y: float = 0.0,
+    ancho: float = 1.0,
+    alto: float = 1.0,
+    dpi: Optional[str] = None,
+    formato: str = "png",
+    calidad: Optional[str] = None,
+):
+    # A region of a previewed flyer at zoom resolution. ``x``/``y``/``ancho``/
+    # ``alto`` are fractions of the page from the top left; ``flyer_key`` is
+    # the X-Flyer-Key of the preview. Rendered from the cached PDF.
+    if not FLYER_KEY_RE.match(flyer_key):
+        raise HTTPException(status_code=404, detail="La vista previa ya no está disponible. Vuelve a generarla.")
+    left, top = max(0.0, min(1.0, x)), max(0.0, min(1.0, y))
+    width, height = min(ancho, 1.0 - left), min(alto, 1.0 - top)
+    if not width > 0 or not height > 0:
+        raise HTTPException(status_code=400, detail="La zona pedida está fuera de la página.")
+    options = parse_preview_options(dpi, None, formato, calidad, default_dpi=TILE_DPI, max_dpi=TILE_MAX_DPI)
+    zoom = options.dpi / 72
+    if width * A4[0] * zoom * height * A4[1] * zoom > TILE_MAX_PIXELS:
+        raise HTTPException(status_code=400, detail="La zona pedida es demasiado grande para esa resolución.")
+
+    region = (left, top, width, height)
+    tile_key = f"tile:{options.variant}:{','.join(f'{v:g}' for v in region)}:{flyer_key}"
+    cached = await _cache_get(tile_key)
     if cached is not None:
-        return Response(content=cached, media_type="image/png")
+        return Response(content=cached, media_type=options.media_type)
+    try:
+        image_bytes = await RENDER_POOL.run(render_tile, flyer_key, None, region, options)
+        if image_bytes is None:
+            pdf_bytes = await _cache_get(f"pdf:{flyer_key}")
+            if pdf_bytes is None:
+                raise HTTPException(status_code=404, detail="La vista previa ya no está disponible. Vuelve a generarla.")
+            image_bytes = await RENDER_POOL.run(render_tile, flyer_key, pdf_bytes, region, options)
+    except RenderQueueFull:
+        raise HTTPException(status_code=503, detail="El servidor está ocupado. Inténtalo de nuevo en unos segundos.")
+    await _cache_set(tile_key, image_bytes)
+    return Response(content=image_bytes, media_type=options.media_type)
 
-    tmp_dir = Path(tempfile.mkdtemp(prefix="newhome_preview_"))
 
-    def save_upload_bytes(data: Optional[bytes], filename: Optional[str]) -> Optional[str]:
-        if not data:
-            return None
-        suffix = Path(filename or "upload").suffix or ".png"
-        tmp_path = tmp_dir / f"{next(tempfile._get_candidate_names())}{suffix}"
-        with tmp_path.open("wb") as f:
-            f.write(data)
-        return str(tmp_path)
-
-    data = FlyerData(
-        texto1=texto1,
-        color_texto1=color_texto1,
-        texto_marca=texto_marca,
-        color_texto_marca=color_texto_marca,
-        texto2=texto2,
-        color_texto2=color_texto2,
-        texto2_fondo=save_upload_bytes(fondo_bytes, getattr(texto2_fondo, "filename", None)),
-        texto3=texto3,
-        color_texto3=color_texto3,
-        texto4=texto4,
-        color_texto4=color_texto4,
-        rebajado=parse_bool(rebajado, True),
-        habitaciones=int(habitaciones),
-        banos=int(banos),
-        jardin=parse_bool(jardin),
-        garaje=parse_bool(garaje),
-        piscina=parse_bool(piscina),
-        borde_caracteristicas=borde_caracteristicas,
-        color_borde_caracteristicas=color_borde_caracteristicas,
-        descripcion=descripcion,
-        color_descripcion=color_descripcion,
-        descripcion_tamano=parse_description_font_size(descripcion_tamano),
-        precio=precio,
-        color_precio=color_precio,
-        energia=energia,
-        escala_imagenes=parse_scale(escala_imagenes),
-        imagen1_escala=parse_scale(imagen1_escala, 1.0),
-        imagen1_offset_x=parse_offset(imagen1_offset_x),
-        imagen1_offset_y=parse_offset(imagen1_offset_y),
-        imagen1_modo=parse_image_mode(imagen1_modo),
-        imagen1_custom_ancho=parse_dimension_percent(imagen1_custom_ancho),
-        imagen1_custom_alto=parse_dimension_percent(imagen1_custom_alto),
-        imagen2_escala=parse_scale(imagen2_escala, 1.0),
-        imagen2_offset_x=parse_offset(imagen2_offset_x),
-        imagen2_offset_y=parse_offset(imagen2_offset_y),
-        imagen2_modo=parse_image_mode(imagen2_modo),
-        imagen2_custom_ancho=parse_dimension_percent(imagen2_custom_ancho),
-        imagen2_custom_alto=parse_dimension_percent(imagen2_custom_alto),
-        imagen3_escala=parse_scale(imagen3_escala, 1.0),
-        imagen3_offset_x=parse_offset(imagen3_offset_x),
-        imagen3_offset_y=parse_offset(imagen3_offset_y),
-        imagen3_modo=parse_image_mode(imagen3_modo),
-        imagen3_custom_ancho=parse_dimension_percent(imagen3_custom_ancho),
-        imagen3_custom_alto=parse_dimension_percent(imagen3_custom_alto),
-        imagen4_escala=parse_scale(imagen4_escala, 1.0),
-        imagen4_offset_x=parse_offset(imagen4_offset_x),
-        imagen4_offset_y=parse_offset(imagen4_offset_y),
-        imagen4_modo=parse_image_mode(imagen4_modo),
-        imagen4_custom_ancho=parse_dimension_percent(imagen4_custom_ancho),
-        imagen4_custom_alto=parse_dimension_percent(imagen4_custom_alto),
-        imagen1=save_upload_bytes(imagen1_bytes, getattr(imagen1, "filename", None)),
-        imagen2=save_upload_bytes(imagen2_bytes, getattr(imagen2, "filename", None)),
-        imagen3=save_upload_bytes(imagen3_bytes, getattr(imagen3, "filename", None)),
-        imagen4=save_upload_bytes(imagen4_bytes, getattr(imagen4, "filename", None)),
-        qr_imagen=save_upload_bytes(qr_bytes, getattr(qr_imagen, "filename", None)),
-    )
+# Background jobs: the same specs as /api/pdf/batch, rendered without holding
+# the request open. "pdf" and "preview" take a single flyer.
+JOB_KINDS = {
+    "pdf": ("application/pdf", "flyer.pdf"),
+    "preview": ("image/png", "preview.png"),
+    "batch": ("application/zip", "flyers.zip"),
+    "catalog": ("application/pdf", "catalogo.pdf"),
+}
+
+BatchItems = list[tuple[str, FlyerData, dict[str, Optional[str]]]]
+
+
+async def _pdf_job(job: Job, items: BatchItems) -> RenderedDocument:
+    (_, data, refs), = items
+    pdf_bytes = await _render_batch_item(data, refs)
+    return RenderedDocument(size=len(pdf_bytes), data=pdf_bytes)
+
+
+async def _preview_job(job: Job, items: BatchItems) -> RenderedDocument:
+    (_, data, refs), = items
+    cache_key = fingerprint(data, refs)
+    options = PreviewOptions()
+    png_bytes = await _cache_get(f"preview:{options.variant}:{cache_key}")
+    if png_bytes is None:
+        render_job = build_job(data, await run_in_threadpool(_load_stored_images, refs))
+        png_bytes = await _render_preview_image(cache_key, render_job, options, _run_when_free)
+    return RenderedDocument(size=len(png_bytes), data=png_bytes)
 
-    pdf_buffer = io.BytesIO()
-    generate_pdf(data, pdf_buffer)
-    pdf_buffer.seek(0)
 
-    doc = fitz.open(stream=pdf_buffer.getvalue(), filetype="pdf")
+async def _batch_job(job: Job, items: BatchItems) -> RenderedDocument:
+    output = SpooledOutput()
+    async for chunk in _stream_batch(items, on_entry=job.advance):
+        await run_in_threadpool(output.write, chunk)
+    return await run_in_threadpool(output.result)
+
+
+async def _catalog_job(job: Job, items: BatchItems) -> RenderedDocument:
+    return await _run_when_free(render_catalog, await run_in_threadpool(_catalog_jobs, items))
+
+
+JOB_RUNNERS = {"pdf": _pdf_job, "preview": _preview_job, "batch": _batch_job, "catalog": _catalog_job}
+
+
+def _get_job(job_id: str) -> Job:
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="El trabajo no existe o ya ha caducado.")
+    return job
+
+
+def _job_response(job: Job) -> dict[str, Any]:
+    return {**job.snapshot(), "events": f"/api/jobs/{job.id}/events", "result": f"/api/jobs/{job.id}/result"}
+
+
+@app.post("/api/jobs/{kind}", status_code=202)
+async def create_job(kind: str, request: Request):
+    if kind not in JOB_KINDS:
+        raise HTTPException(status_code=404, detail="Tipo de trabajo desconocido.")
+    items = await _read_batch_request(request)
+    if kind in ("pdf", "preview") and len(items) != 1:
+        raise HTTPException(status_code=400, detail="Este trabajo admite una sola ficha.")
+    media_type, filename = JOB_KINDS[kind]
+    runner = JOB_RUNNERS[kind]
     try:
-        page = doc.load_page(0)
-        pix = page.get_pixmap(dpi=120, alpha=False)
-        png_bytes = pix.tobytes("png")
-    finally:
-        doc.close()
+        job = JOBS.submit(
+            kind, len(items), media_type, filename, lambda job: runner(job, items), _render_error_message
+        )
+    except JobsFull:
+        raise HTTPException(status_code=503, detail="Hay demasiados trabajos en curso. Inténtalo de nuevo en unos minutos.")
+    return _job_response(job)
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    return _job_response(_get_job(job_id))
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    # Server-Sent Events: a "progress" event per change, then one named after
+    # the final status; comment lines keep idle connections open.
+    job = _get_job(job_id)
+
+    async def stream():
+        async for snapshot in job.events():
+            if snapshot is None:
+                yield ": ping\n\n"
+                continue
+            event = snapshot["status"] if snapshot["status"] in (DONE, FAILED) else "progress"
+            yield f"event: {event}\ndata: {json.dumps(snapshot)}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
-    _cache_set(cache_key, png_bytes)
-    return Response(content=png_bytes, media_type="image/png")
+@app.get("/api/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = _get_job(job_id)
+    if job.status == FAILED:
+        raise HTTPException(status_code=409, detail=job.error or "El trabajo ha fallado.")
+    if job.result is None:
+        raise HTTPException(status_code=409, detail="El trabajo todavía no ha terminado.")
+    headers = {"Content-Disposition": f"attachment; filename={job.filename}"}
+    if job.result.data is not None:
+        return Response(content=job.result.data, media_type=job.media_type, headers=headers)
+    return FileResponse(job.result.path, media_type=job.media_type, headers=headers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,322 @@
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+from typing import Callable, Optional
+
+from PIL import Image
+
+from pdf_generator import FlyerData, load_static_assets
+from server.render_pool import (
+    RenderJob,
+    render_layered_preview,
+    render_pdf_document,
+    render_preview,
+    render_raster_preview,
+)
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "bench_baseline.json"
+
+# Relative growth over the baseline that counts as a regression. Latency
+# differences below MIN_LATENCY_DELTA_MS are timer noise and never fail.
+MAX_SLOWDOWN = 0.20
+MAX_RSS_GROWTH = 0.20
+MAX_SIZE_GROWTH = 0.10
+MIN_LATENCY_DELTA_MS = 3.0
+
+
+def _render_pdf(job: RenderJob) -> int:
+    document = render_pdf_document(job)
+    if document.path is not None:
+        os.unlink(document.path)
+    return document.size
+
+
+# Each pipeline renders one job and returns the size of its output.
+PIPELINES: dict[str, Callable[[RenderJob], int]] = {
+    "pdf": _render_pdf,
+    "preview": lambda job: len(render_preview(job)[1]),
+    "layered": lambda job: len(render_layered_preview(job)),
+    "raster": lambda job: len(render_raster_preview(job)),
+}
+
+
+def synthetic_jpeg(size: tuple[int, int], noise: float) -> bytes:
+    # Gradients with sensor-like noise, so the JPEG decodes and compresses
+    # like a photo rather than a flat test pattern.
+    gradient = Image.linear_gradient("L").resize(size)
+    channels = [gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT), gradient.transpose(Image.FLIP_TOP_BOTTOM)]
+    if noise:
+        grain = Image.effect_noise(size, noise)
+        channels = [Image.blend(channel, grain, 0.25) for channel in channels]
+    buffer = io.BytesIO()
+    Image.merge("RGB", channels).save(buffer, format="JPEG", quality=88)
+    return buffer.getvalue()
+
+
+def synthetic_png(size: tuple[int, int]) -> bytes:
+    gradient = Image.linear_gradient("L").resize(size)
+    alpha = Image.radial_gradient("L").resize(size).point(lambda v: 255 - v)
+    buffer = io.BytesIO()
+    Image.merge("RGBA", (gradient, gradient.rotate(180), gradient.transpose(Image.FLIP_LEFT_RIGHT), alpha)).save(
+        buffer, format="PNG"
+    )
+    return buffer.getvalue()
+
+
+def _flyer(**overrides) -> FlyerData:
+    images = {}
+    for i in range(1, 5):
+        images.update(
+            {
+                f"imagen{i}_escala": 1.0,
+                f"imagen{i}_offset_x": 0.0,
+                f"imagen{i}_offset_y": 0.0,
+                f"imagen{i}_modo": "contain",
+                f"imagen{i}_custom_ancho": 90.0,
+                f"imagen{i}_custom_alto": 110.0,
+            }
+        )
+    values = dict(
+        texto1="Venta",
+        color_texto1="#ffffff",
+        texto_marca="NewHome",
+        color_texto_marca="#ffffff",
+        texto2="Calle Mayor 1, Madrid",
+        color_texto2="#000000",
+        texto2_fondo=None,
+        texto3="120 m² construidos",
+        color_texto3="#000000",
+        texto4="REBAJADO",
+        color_texto4="#ffffff",
+        rebajado=True,
+        habitaciones=3,
+        banos=2,
+        jardin=True,
+        garaje=True,
+        piscina=False,
+        borde_caracteristicas="solid",
+        color_borde_caracteristicas="#111111",
+        descripcion="Luminoso piso reformado con terraza, cocina amueblada y vistas despejadas. " * 5,
+        color_descripcion="#000000",
+        descripcion_tamano=9.0,
+        precio="154.900€",
+        color_precio="#b9cdb8",
+        energia="C",
+        escala_imagenes=0.93,
+        imagen1=None,
+        imagen2=None,
+        imagen3=None,
+        imagen4=None,
+        qr_imagen=None,
+        **images,
+    )
+    values.update(overrides)
+    return FlyerData(**values)
+
+
+def _with_photos(data: FlyerData, photo: bytes, mode: str = "contain") -> FlyerData:
+    slots = {f"imagen{i}": photo for i in range(1, 5)}
+    modes = {f"imagen{i}_modo": mode for i in range(1, 5)}
+    return replace(data, **slots, **modes)
+
+
+def build_corpus() -> dict[str, FlyerData]:
+    # Deterministic: the same cases, images and text on every run.
+    photo = synthetic_jpeg((1600, 1067), noise=12)
+    photo_24mp = synthetic_jpeg((6000, 4000), noise=12)
+    alpha = synthetic_png((1600, 1200))
+    qr = synthetic_png((400, 400))
+    empty = {name: "" for name in ("texto1", "texto_marca", "texto2", "texto3", "texto4", "descripcion", "precio")}
+    long_text = " ".join(f"palabra{i % 37} luminoso reformado" for i in range(60))
+    unbroken = "x" * 400
+
+    typical = _with_photos(_flyer(qr_imagen=qr), photo)
+    corpus = {
+        "empty": _flyer(rebajado=False, habitaciones=0, banos=0, jardin=False, garaje=False, **empty),
+        "typical": typical,
+        "rebajado_off": replace(typical, rebajado=False),
+        "long_description": replace(typical, descripcion=long_text[:1500]),
+        "long_words": replace(typical, descripcion=f"{unbroken} {unbroken} fin", texto2="Urbanización" * 12),
+        "alpha_png": _with_photos(_flyer(qr_imagen=alpha, texto2_fondo=alpha), alpha, "cover"),
+    }
+    for mode in ("contain", "cover", "expand", "custom"):
+        corpus[f"photo_24mp_{mode}"] = _with_photos(_flyer(), photo_24mp, mode)
+    return corpus
+
+
+def _proc_status_mb(field: str) -> Optional[float]:
+    try:
+        with open("/proc/self/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _rss_mb() -> float:
+    current = _proc_status_mb("VmRSS")
+    return current if current is not None else _peak_rss_mb()
+
+
+def _peak_rss_mb() -> float:
+    # VmHWM belongs to this process image; ru_maxrss survives exec on Linux
+    # and would report the parent's peak for a freshly spawned worker.
+    peak = _proc_status_mb("VmHWM")
+    if peak is not None:
+        return peak
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+def percentile(values: list[float], percent: float) -> float:
+    # Nearest rank, so small samples report a value that was actually seen.
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def _run_case(pipeline: str, data: FlyerData, repeat: int, warmup: int) -> dict:
+    # Runs in a fresh process, so the peak RSS belongs to this case alone.
+    load_static_assets()
+    render = PIPELINES[pipeline]
+    job = RenderJob(data=data)
+    rss_before = _rss_mb()
+    for _ in range(warmup):
+        render(job)
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = render(job)
+        timings.append((time.perf_counter() - start) * 1000)
+    peak = _peak_rss_mb()
+    return {
+        "runs": repeat,
+        "p50_ms": round(percentile(timings, 50), 2),
+        "p95_ms": round(percentile(timings, 95), 2),
+        "max_ms": round(max(timings), 2),
+        "peak_rss_mb": round(peak, 1),
+        "rss_growth_mb": round(peak - rss_before, 1),
+        "size_bytes": size,
+    }
+
+
+def run_benchmarks(
+    cases: Optional[list[str]] = None,
+    pipelines: Optional[list[str]] = None,
+    repeat: int = 5,
+    warmup: int = 1,
+) -> dict[str, dict]:
+    corpus = build_corpus()
+    results: dict[str, dict] = {}
+    context = multiprocessing.get_context("spawn")
+    for case, data in corpus.items():
+        if cases and case not in cases:
+            continue
+        for pipeline in pipelines or PIPELINES:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_case, pipeline, data, repeat, warmup).result()
+            results[f"{case}/{pipeline}"] = result
+            print(f"  {case}/{pipeline}: p50 {result['p50_ms']} ms", file=sys.stderr, flush=True)
+    return results
+
+
+def compare(
+    results: dict[str, dict],
+    baseline: dict[str, dict],
+    max_slowdown: float = MAX_SLOWDOWN,
+    max_rss_growth: float = MAX_RSS_GROWTH,
+    max_size_growth: float = MAX_SIZE_GROWTH,
+) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in ("p50_ms", "p95_ms"):
+            delta = result[metric] - before[metric]
+            if delta > MIN_LATENCY_DELTA_MS and result[metric] > before[metric] * (1 + max_slowdown):
+                regressions.append(f"{name} {metric}: {before[metric]} -> {result[metric]}")
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + max_rss_growth):
+            regressions.append(f"{name} peak_rss_mb: {before['peak_rss_mb']} -> {result['peak_rss_mb']}")
+        if result["size_bytes"] > before["size_bytes"] * (1 + max_size_growth):
+            regressions.append(f"{name} size_bytes: {before['size_bytes']} -> {result['size_bytes']}")
+    return regressions
+
+
+def format_report(results: dict[str, dict], baseline: Optional[dict[str, dict]] = None) -> str:
+    header = f"{'case':<32} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'rss MB':>8} {'+rss MB':>8} {'size':>10}"
+    if baseline:
+        header += f" {'p50 vs base':>12}"
+    lines = [header, "-" * len(header)]
+    for name, r in results.items():
+        line = (
+            f"{name:<32} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['max_ms']:>9.2f} "
+            f"{r['peak_rss_mb']:>8.1f} {r['rss_growth_mb']:>8.1f} {r['size_bytes']:>10}"
+        )
+        before = (baseline or {}).get(name)
+        if before:
+            line += f" {(r['p50_ms'] / before['p50_ms'] - 1) * 100:>+11.1f}%"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m server.bench",
+        description="Times generate_pdf and the preview pipelines on a synthetic flyer corpus.",
+    )
+    parser.add_argument("--cases", help="comma-separated case names (default: all)")
+    parser.add_argument("--pipelines", help=f"comma-separated, from {', '.join(PIPELINES)} (default: all)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="results to compare against")
+    parser.add_argument("--save", action="store_true", help="write these results as the new baseline")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--max-slowdown", type=float, default=MAX_SLOWDOWN)
+    parser.add_argument("--max-rss-growth", type=float, default=MAX_RSS_GROWTH)
+    parser.add_argument("--max-size-growth", type=float, default=MAX_SIZE_GROWTH)
+    args = parser.parse_args(argv)
+
+    cases = args.cases.split(",") if args.cases else None
+    pipelines = args.pipelines.split(",") if args.pipelines else None
+    unknown = [name for name in pipelines or () if name not in PIPELINES]
+    if unknown:
+        parser.error(f"unknown pipelines: {', '.join(unknown)}")
+    results = run_benchmarks(cases, pipelines, max(1, args.repeat), max(0, args.warmup))
+
+    baseline = None
+    if args.baseline.exists() and not args.save:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    print(json.dumps(results, indent=2) if args.json else format_report(results, baseline))
+
+    if args.save:
+        saved = json.loads(args.baseline.read_text(encoding="utf-8")) if args.baseline.exists() else {}
+        saved.update(results)
+        args.baseline.write_text(json.dumps(saved, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline, args.max_slowdown, args.max_rss_growth, args.max_size_growth)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    # python -m server.bench [--save]  -> latency, peak RSS and output size
+    # per case and pipeline, checked against the saved baseline.
+    sys.exit(main())
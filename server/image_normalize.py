@@ -0,0 +1,91 @@
+import io
+from typing import Optional
+
+from PIL import Image, ImageCms, ImageOps
+
+from server.metrics import stage
+
+NORMALIZED_JPEG_QUALITY = 92
+EXIF_ORIENTATION = 0x0112
+GRAPHIC_MAX_COLORS = 256
+
+_SRGB = ImageCms.createProfile("sRGB")
+
+
+def _has_alpha(img: Image.Image) -> bool:
+    return img.mode in {"RGBA", "LA", "PA"} or (img.mode == "P" and "transparency" in img.info)
+
+
+def _is_srgb(icc_profile: Optional[bytes]) -> bool:
+    if not icc_profile:
+        return True
+    try:
+        profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        return "srgb" in ImageCms.getProfileDescription(profile).lower()
+    except (ImageCms.PyCMSError, OSError):
+        return True
+
+
+def _is_upright_srgb(img: Image.Image) -> bool:
+    return img.getexif().get(EXIF_ORIENTATION, 1) == 1 and _is_srgb(img.info.get("icc_profile"))
+
+
+def _is_render_ready(img: Image.Image) -> bool:
+    # A baseline RGB or gray JPEG, upright and in sRGB, is embedded by
+    # reportlab as is; re-encoding it would only lose quality.
+    return (
+        img.format == "JPEG"
+        and img.mode in {"RGB", "L"}
+        and not img.info.get("progressive")
+        and _is_upright_srgb(img)
+    )
+
+
+def _to_srgb(img: Image.Image) -> Image.Image:
+    alpha = _has_alpha(img)
+    mode = "RGBA" if alpha else "RGB"
+    icc_profile = img.info.get("icc_profile")
+    if icc_profile and not _is_srgb(icc_profile):
+        try:
+            source = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+            if img.mode not in {"RGB", "RGBA", "CMYK", "L"}:
+                img = img.convert(mode)
+            return ImageCms.profileToProfile(img, source, _SRGB, outputMode=mode if img.mode != "L" else "L")
+        except (ImageCms.PyCMSError, OSError, ValueError):
+            pass
+    if img.mode in {"L", mode}:
+        return img
+    if img.mode == "1":
+        return img.convert("L")
+    return img.convert(mode)
+
+
+def normalize_image(data: bytes) -> bytes:
+    # Ingest-time normalization, so every render starts from the cheap case:
+    # EXIF orientation applied, colours converted to sRGB, an alpha channel
+    # dropped when fully opaque, and photos re-encoded as baseline JPEG that
+    # reportlab embeds without decoding (and Pillow can draft-decode when
+    # resampling). Images with real transparency stay PNG; the photo cells
+    # flatten them at render time. Raises what Pillow raises for bad data.
+    with stage("image_normalize"), Image.open(io.BytesIO(data)) as img:
+        if _is_render_ready(img):
+            return data
+        upright = ImageOps.exif_transpose(img)
+        # Palette, gray or few-colour images are logos, drawings or QR codes
+        # more often than photos, and JPEG would blur them; they stay lossless.
+        graphic = img.format != "JPEG" and (
+            upright.mode in {"1", "L", "LA", "P", "PA"} or upright.getcolors(GRAPHIC_MAX_COLORS) is not None
+        )
+        if graphic and img.format == "PNG" and _is_upright_srgb(img):
+            return data
+        upright = _to_srgb(upright)
+        # The pixels are sRGB now; PNG would otherwise carry the old profile.
+        upright.info.pop("icc_profile", None)
+        if upright.mode == "RGBA" and upright.getchannel("A").getextrema() == (255, 255):
+            upright = upright.convert("RGB")
+        buffer = io.BytesIO()
+        if graphic or upright.mode == "RGBA":
+            upright.save(buffer, format="PNG")
+        else:
+            upright.save(buffer, format="JPEG", quality=NORMALIZED_JPEG_QUALITY, progressive=False)
+        return buffer.getvalue()
@@ -0,0 +1,33 @@
+import hashlib
+import os
+import re
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from server.render_cache import DiskCache, env_int
+
+IMAGE_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ImageStore(DiskCache):
+    # Uploads are stored once under their SHA-256 so the client can refer to
+    # them by ID on every later preview/PDF request.
+    def contains(self, image_id: str) -> bool:
+        return bool(IMAGE_ID_RE.match(image_id)) and super().contains(image_id)
+
+    def get(self, image_id: str) -> Optional[bytes]:
+        if not IMAGE_ID_RE.match(image_id):
+            return None
+        return super().get(image_id)
+
+    def put(self, data: bytes, image_id: Optional[str] = None) -> str:
+        # ``image_id`` may be passed when the caller already hashed the data.
+        image_id = image_id or hashlib.sha256(data).hexdigest()
+        self.set(image_id, data)
+        return image_id
+
+
+def store_from_env() -> ImageStore:
+    root = os.environ.get("NEWHOME_IMAGE_STORE_DIR") or str(Path(tempfile.gettempdir()) / "newhome_images")
+    return ImageStore(Path(root), env_int("NEWHOME_IMAGE_STORE_MAX_MB", 512) * 1024 * 1024)
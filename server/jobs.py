@@ -0,0 +1,176 @@
+import asyncio
+import os
+import secrets
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from server.render_cache import env_int
+from server.render_pool import RenderedDocument
+
+JOBS_MAX_ACTIVE = env_int("NEWHOME_JOBS_MAX", 4)
+JOBS_TTL = env_int("NEWHOME_JOBS_TTL", 900)
+JOBS_HEARTBEAT = 15.0
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobsFull(Exception):
+    pass
+
+
+class Job:
+    # One background render. Progress is counted in steps (flyers); every
+    # change wakes the clients following it.
+    def __init__(self, kind: str, total: int, media_type: str, filename: str) -> None:
+        self.id = secrets.token_urlsafe(16)
+        self.kind = kind
+        self.total = total
+        self.done = 0
+        self.status = QUEUED
+        self.media_type = media_type
+        self.filename = filename
+        self.result: Optional[RenderedDocument] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._expires_at: Optional[float] = None
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def start(self) -> None:
+        self.status = RUNNING
+        self._notify()
+
+    def advance(self, steps: int = 1) -> None:
+        self.done = min(self.total, self.done + steps)
+        self._notify()
+
+    def _finish(
+        self, status: str, ttl: float, result: Optional[RenderedDocument] = None, error: Optional[str] = None
+    ) -> None:
+        self.status = status
+        self.result = result
+        self.error = error
+        if status == DONE:
+            self.done = self.total
+        self.finished_at = time.time()
+        self._expires_at = time.monotonic() + ttl
+        self._notify()
+
+    def _discard(self) -> None:
+        if self.result is not None and self.result.path is not None:
+            try:
+                os.unlink(self.result.path)
+            except FileNotFoundError:
+                pass
+        self.result = None
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "error": self.error,
+            "size": self.result.size if self.result is not None else None,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+    async def events(self, heartbeat: float = JOBS_HEARTBEAT) -> AsyncIterator[Optional[dict[str, Any]]]:
+        # Yields a snapshot now and after every change until the job ends;
+        # None marks a quiet ``heartbeat`` interval so the caller can keep
+        # the connection alive through proxies.
+        while True:
+            changed = self._changed
+            yield self.snapshot()
+            if self.finished:
+                return
+            while True:
+                try:
+                    await asyncio.wait_for(changed.wait(), heartbeat)
+                    break
+                except asyncio.TimeoutError:
+                    yield None
+
+
+class JobRegistry:
+    # In-process registry: at most ``max_active`` jobs queued or running at
+    # once, finished jobs kept for ``ttl`` seconds for download. Jobs live in
+    # the worker that accepted them, so polling must reach the same process.
+    def __init__(self, max_active: int = JOBS_MAX_ACTIVE, ttl: float = JOBS_TTL) -> None:
+        self.max_active = max(1, max_active)
+        self.ttl = ttl
+        self._jobs: dict[str, Job] = {}
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if job._expires_at is not None and job._expires_at <= now:
+                job._discard()
+                del self._jobs[job_id]
+
+    @property
+    def active(self) -> int:
+        return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def submit(
+        self,
+        kind: str,
+        total: int,
+        media_type: str,
+        filename: str,
+        work: Callable[[Job], Awaitable[RenderedDocument]],
+        describe_error: Callable[[Exception], str] = str,
+    ) -> Job:
+        self._expire()
+        if self.active >= self.max_active:
+            raise JobsFull()
+        job = Job(kind, total, media_type, filename)
+        self._jobs[job.id] = job
+        job._task = asyncio.ensure_future(self._run(job, work, describe_error))
+        return job
+
+    async def _run(
+        self,
+        job: Job,
+        work: Callable[[Job], Awaitable[RenderedDocument]],
+        describe_error: Callable[[Exception], str],
+    ) -> None:
+        job.start()
+        try:
+            result = await work(job)
+        except asyncio.CancelledError:
+            job._finish(FAILED, self.ttl, error="Cancelado.")
+            raise
+        except Exception as exc:
+            job._finish(FAILED, self.ttl, error=describe_error(exc))
+        else:
+            job._finish(DONE, self.ttl, result=result)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._expire()
+        return self._jobs.get(job_id)
+
+    def stats(self) -> dict[str, Any]:
+        self._expire()
+        return {"jobs": len(self._jobs), "active": self.active, "max_active": self.max_active}
+
+    def shutdown(self) -> None:
+        for job in self._jobs.values():
+            if job._task is not None and not job._task.done():
+                job._task.cancel()
+            job._discard()
+        self._jobs.clear()
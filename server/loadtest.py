@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from server.bench import percentile, synthetic_jpeg, synthetic_png
+
+WORDS = (
+    "luminoso reformado terraza vistas cocina amueblada dormitorios baños garaje trastero "
+    "piscina comunitaria jardín privado zona tranquila cerca de colegios ascensor orientación sur"
+).split()
+
+
+@dataclass
+class Sample:
+    endpoint: str
+    seconds: float
+    ok: bool
+    status: Optional[int] = None
+
+
+@dataclass
+class Images:
+    ids: dict[str, str] = field(default_factory=dict)
+
+
+@asynccontextmanager
+async def _client(url: Optional[str], timeout: float) -> AsyncIterator[httpx.AsyncClient]:
+    # Without a URL the app runs in this process, lifespan included; client
+    # and server then share one event loop, which the numbers include.
+    if url:
+        async with httpx.AsyncClient(base_url=url, timeout=timeout) as client:
+            yield client
+        return
+    from server.app import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=timeout) as client:
+            yield client
+
+
+async def _upload_images(client: httpx.AsyncClient) -> Images:
+    # The client flow: photos go to the image store once, and every preview
+    # after that only carries their IDs.
+    uploads = {
+        "imagen1": ("salon.jpg", synthetic_jpeg((1600, 1067), noise=12), "image/jpeg"),
+        "imagen2": ("cocina.jpg", synthetic_jpeg((1200, 1600), noise=18), "image/jpeg"),
+        "qr_imagen": ("qr.png", synthetic_png((400, 400)), "image/png"),
+    }
+    images = Images()
+    for slot, upload in uploads.items():
+        response = await client.post("/api/images", files={"imagen": upload})
+        response.raise_for_status()
+        images.ids[f"{slot}_id"] = response.json()["id"]
+    return images
+
+
+class TypingUser:
+    # One person editing a flyer: most previews repeat a recent state (the
+    # frontend asking again after a debounce, undo, toggling a field back),
+    # the rest carry a small edit; now and then the PDF is downloaded.
+    def __init__(self, name: str, images: Images, rng: random.Random, repeat_ratio: float, download_ratio: float):
+        self.rng = rng
+        self.repeat_ratio = repeat_ratio
+        self.download_ratio = download_ratio
+        self.state = {
+            "texto1": "Venta",
+            "texto2": f"Calle {name}",
+            "precio": f"{rng.randint(90, 900)}.000€",
+            "habitaciones": str(rng.randint(1, 5)),
+            "descripcion": " ".join(rng.choice(WORDS) for _ in range(40)),
+            **images.ids,
+        }
+        self.recent: list[dict[str, str]] = [dict(self.state)]
+
+    def _edit(self) -> None:
+        roll = self.rng.random()
+        if roll < 0.7:
+            self.state["descripcion"] += " " + self.rng.choice(WORDS)
+        elif roll < 0.85:
+            self.state["precio"] = f"{self.rng.randint(90, 900)}.{self.rng.randint(0, 9)}00€"
+        else:
+            self.state["rebajado"] = self.rng.choice(("true", "false"))
+        self.recent = (self.recent + [dict(self.state)])[-5:]
+
+    def next_request(self) -> tuple[str, dict[str, str]]:
+        if self.rng.random() < self.download_ratio:
+            return "/api/pdf", self.state
+        if self.rng.random() < self.repeat_ratio:
+            return "/api/preview", self.rng.choice(self.recent)
+        self._edit()
+        return "/api/preview", self.state
+
+
+async def _run_user(
+    client: httpx.AsyncClient,
+    user: TypingUser,
+    deadline: float,
+    think: float,
+    samples: list[Sample],
+) -> None:
+    while time.perf_counter() < deadline:
+        endpoint, form = user.next_request()
+        start = time.perf_counter()
+        try:
+            response = await client.post(endpoint, data=form)
+            samples.append(Sample(endpoint, time.perf_counter() - start, response.status_code < 400, response.status_code))
+        except httpx.HTTPError:
+            samples.append(Sample(endpoint, time.perf_counter() - start, False))
+        if think:
+            await asyncio.sleep(user.rng.uniform(0.5, 1.5) * think)
+
+
+def summarize(samples: list[Sample], duration: float) -> dict[str, dict]:
+    groups: dict[str, list[Sample]] = {"all": samples}
+    for sample in samples:
+        groups.setdefault(sample.endpoint, []).append(sample)
+    report = {}
+    for name, group in groups.items():
+        latencies = [sample.seconds * 1000 for sample in group]
+        errors = sum(1 for sample in group if not sample.ok)
+        report[name] = {
+            "requests": len(group),
+            "throughput_rps": round(len(group) / duration, 2),
+            "error_rate": round(errors / len(group), 4) if group else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 1) if group else None,
+            "p95_ms": round(percentile(latencies, 95), 1) if group else None,
+            "p99_ms": round(percentile(latencies, 99), 1) if group else None,
+            "statuses": {
+                str(status): sum(1 for sample in group if sample.status == status)
+                for status in sorted({sample.status for sample in group}, key=str)
+            },
+        }
+    return report
+
+
+async def run_level(
+    client: httpx.AsyncClient,
+    images: Images,
+    concurrency: int,
+    duration: float,
+    think: float,
+    repeat_ratio: float,
+    download_ratio: float,
+    seed: int,
+) -> dict[str, dict]:
+    # Each level gets fresh users and texts, so it does not start on the
+    # previous level's warm cache.
+    samples: list[Sample] = []
+    deadline = time.perf_counter() + duration
+    users = [
+        TypingUser(f"{seed}-{concurrency}-{i}", images, random.Random(f"{seed}-{concurrency}-{i}"), repeat_ratio, download_ratio)
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    await asyncio.gather(*(_run_user(client, user, deadline, think, samples) for user in users))
+    return summarize(samples, time.perf_counter() - start)
+
+
+def format_report(levels: dict[int, dict[str, dict]]) -> str:
+    header = (
+        f"{'users':>5} {'endpoint':<13} {'requests':>8} {'req/s':>8} {'errors':>7} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    )
+    lines = [header, "-" * len(header)]
+    for concurrency, report in levels.items():
+        for name in ("all", "/api/preview", "/api/pdf"):
+            r = report.get(name)
+            if r is None:
+                continue
+            lines.append(
+                f"{concurrency:>5} {name:<13} {r['requests']:>8} {r['throughput_rps']:>8.2f} "
+                f"{r['error_rate'] * 100:>6.1f}% {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['p99_ms']:>9.1f}"
+            )
+    return "\n".join(lines)
+
+
+async def main_async(args: argparse.Namespace) -> dict[int, dict[str, dict]]:
+    levels: dict[int, dict[str, dict]] = {}
+    async with _client(args.url, args.timeout) as client:
+        images = await _upload_images(client)
+        for concurrency in args.concurrency:
+            print(f"  {concurrency} users for {args.duration:g}s…", file=sys.stderr, flush=True)
+            levels[concurrency] = await run_level(
+                client,
+                images,
+                concurrency,
+                args.duration,
+                args.think_ms / 1000,
+                args.repeat_ratio,
+                args.download_ratio,
+                args.seed,
+            )
+    return levels
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m server.loadtest",
+        description="Replays typing previews and PDF downloads at increasing concurrency.",
+    )
+    parser.add_argument("--url", help="server to test, e.g. http://127.0.0.1:8000 (default: the app in-process)")
+    parser.add_argument(
+        "--concurrency",
+        type=lambda value: [int(level) for level in value.split(",")],
+        default=[1, 2, 4, 8],
+        help="comma-separated numbers of concurrent users, one run each (default: 1,2,4,8)",
+    )
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per concurrency level")
+    parser.add_argument("--think-ms", type=float, default=300.0, help="mean pause between a user's requests")
+    parser.add_argument("--repeat-ratio", type=float, default=0.7, help="share of previews that repeat a recent state")
+    parser.add_argument("--download-ratio", type=float, default=0.05, help="share of requests that download the PDF")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    levels = asyncio.run(main_async(args))
+    print(json.dumps(levels, indent=2) if args.json else format_report(levels))
+    return 0
+
+
+if __name__ == "__main__":
+    # python -m server.loadtest [--url http://127.0.0.1:8000]  -> throughput,
+    # p50/p95/p99 latency and error rate per concurrency level.
+    sys.exit(main())
@@ -0,0 +1,248 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+# Upper bounds in seconds; render stages range from sub-millisecond layout
+# solves to multi-second catalogs.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, Any]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in values]
+
+
+class Gauge(_Metric):
+    # Read from ``read`` at scrape time, for values the server already tracks.
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]) -> None:
+        super().__init__(name, documentation)
+        self._read = read
+
+    def samples(self) -> list[str]:
+        return [f"{self.name} {_format_value(self._read())}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # Per label set: counts per bucket (not cumulative), sum, count.
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * len(self.buckets), [0.0, 0.0])
+            counts, totals = series
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            totals[0] += value
+            totals[1] += 1
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            series = sorted((key, (list(counts), list(totals))) for key, (counts, totals) in self._series.items())
+        lines = []
+        for key, (counts, (total, count)) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {_format_value(count)}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        # Prometheus text exposition format, version 0.0.4.
+        lines: list[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.register(
+    Counter("newhome_http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+)
+HTTP_SECONDS = REGISTRY.register(
+    Histogram("newhome_http_request_seconds", "HTTP request duration by route.", ("route",))
+)
+HTTP_BYTES = REGISTRY.register(
+    Counter("newhome_http_bytes_total", "HTTP body bytes received (in) and sent (out).", ("route", "direction"))
+)
+HTTP_EXCEPTIONS = REGISTRY.register(
+    Counter("newhome_http_exceptions_total", "Unhandled exceptions by type.", ("type",))
+)
+STAGE_SECONDS = REGISTRY.register(
+    Histogram("newhome_stage_seconds", "Time spent in each stage of reading, rendering and encoding.", ("stage",))
+)
+RENDERS = REGISTRY.register(Counter("newhome_renders_total", "Calls into the render pool.", ("function",)))
+RENDER_SECONDS = REGISTRY.register(
+    Histogram("newhome_render_seconds", "Render pool calls, including the wait for a worker.", ("function",))
+)
+RENDER_ERRORS = REGISTRY.register(
+    Counter("newhome_render_errors_total", "Failed render pool calls by exception type.", ("function", "type"))
+)
+CACHE_LOOKUPS = REGISTRY.register(
+    Counter("newhome_cache_lookups_total", "Render cache lookups by entry kind and result.", ("kind", "result"))
+)
+UPLOAD_BYTES = REGISTRY.register(Counter("newhome_upload_bytes_total", "Image bytes received in uploads."))
+
+
+# Render pool workers collect their stage timings here and hand them back
+# with the result, so stages measured in another process still end up in
+# this registry.
+_local = threading.local()
+
+
+def record_stage(name: str, seconds: float) -> None:
+    stages: Optional[list[tuple[str, float]]] = getattr(_local, "stages", None)
+    if stages is not None:
+        stages.append((name, seconds))
+    else:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def collect_stages(fn: Callable[..., Any], *args: Any) -> tuple[Any, list[tuple[str, float]]]:
+    # Runs in the worker: returns ``fn``'s result with the stages it timed.
+    _local.stages = stages = []
+    try:
+        return fn(*args), stages
+    finally:
+        _local.stages = None
+
+
+def observe_stages(stages: list[tuple[str, float]]) -> None:
+    for name, seconds in stages:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+class MetricsMiddleware:
+    # Counts requests, durations and body bytes per route template (never the
+    # raw path, which carries keys and IDs).
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        received = sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message) -> None:
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        except Exception as exc:
+            HTTP_EXCEPTIONS.inc(type=type(exc).__name__)
+            raise
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "other"
+            HTTP_REQUESTS.inc(method=scope["method"], route=path, status=status)
+            HTTP_SECONDS.observe(time.perf_counter() - start, route=path)
+            HTTP_BYTES.inc(received, route=path, direction="in")
+            HTTP_BYTES.inc(sent, route=path, direction="out")
@@ -0,0 +1,124 @@
+import cProfile
+import os
+import pstats
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+from server.render_cache import env_int
+
+PROFILE_DIR = Path(os.environ.get("NEWHOME_PROFILE_DIR") or Path(tempfile.gettempdir()) / "newhome_profiles")
+PROFILE_KEEP = env_int("NEWHOME_PROFILE_KEEP", 50)
+PROFILE_SAMPLE_INTERVAL = 0.001
+
+# One profiled call per process at a time: the samples then belong to a
+# single render, and newer Pythons allow only one active cProfile anyway.
+_PROFILE_LOCK = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class _Sampler(threading.Thread):
+    # Records the Python stack of one thread every ``interval`` seconds, as
+    # collapsed stacks ("outer;inner;leaf" -> count). Time spent inside PIL
+    # or fitz shows up under the Python frame that called into them.
+    def __init__(self, thread_id: int, stop_code, interval: float = PROFILE_SAMPLE_INTERVAL) -> None:
+        super().__init__(name="newhome-profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.stop_code = stop_code
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None and frame.f_code is not self.stop_code:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            if labels:
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def stop(self) -> Counter[str]:
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profiled:
+    # Wraps a render function so it runs under cProfile and the stack
+    # sampler in the worker; both results travel back with the return value.
+    # Keeps the wrapped name so pool metrics still label the real function.
+    def __init__(self, fn: Callable[..., Any]) -> None:
+        self.fn = fn
+        self.__name__ = getattr(fn, "__name__", "render")
+
+    def __call__(self, *args: Any) -> tuple[Any, dict, Counter[str]]:
+        with _PROFILE_LOCK:
+            profiler = cProfile.Profile()
+            sampler = _Sampler(threading.get_ident(), Profiled.__call__.__code__)
+            sampler.start()
+            profiler.enable()
+            try:
+                result = self.fn(*args)
+            finally:
+                profiler.disable()
+                stacks = sampler.stop()
+            profiler.create_stats()
+            return result, profiler.stats, stacks
+
+
+class _StatsSnapshot:
+    # The interface pstats.Stats loads from: raw stats from another process.
+    def __init__(self, stats: dict) -> None:
+        self.stats = stats
+
+    def create_stats(self) -> None:
+        pass
+
+
+class RequestProfile:
+    # Profiles of every render call made for one request, saved together as
+    # ``<id>.pstats`` (open with ``python -m pstats`` or snakeviz) and
+    # ``<id>.collapsed`` (flamegraph.pl, speedscope).
+    def __init__(self, endpoint: str) -> None:
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{secrets.token_hex(3)}"
+        self._stats: list[dict] = []
+        self._stacks: Counter[str] = Counter()
+
+    def runner(self, run: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        # Wraps a pool's ``run`` so every call through it is profiled.
+        async def profiled_run(fn: Callable[..., Any], *args: Any) -> Any:
+            result, stats, stacks = await run(Profiled(fn), *args)
+            self._stats.append(stats)
+            self._stacks.update(stacks)
+            return result
+
+        return profiled_run
+
+    def save(self, directory: Path = PROFILE_DIR, keep: int = PROFILE_KEEP) -> Optional[str]:
+        if not self._stats:
+            return None
+        directory.mkdir(parents=True, exist_ok=True)
+        pstats.Stats(*(_StatsSnapshot(stats) for stats in self._stats)).dump_stats(directory / f"{self.id}.pstats")
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items()))
+        (directory / f"{self.id}.collapsed").write_text(collapsed, encoding="utf-8")
+        prune_profiles(directory, keep)
+        return self.id
+
+
+def prune_profiles(directory: Path = PROFILE_DIR, keep: int = PROFILE_KEEP) -> None:
+    # Keeps the ``keep`` most recent profiles, each a .pstats/.collapsed pair.
+    profiles = sorted(directory.glob("*.pstats"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for path in profiles[max(0, keep):]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".collapsed").unlink(missing_ok=True)
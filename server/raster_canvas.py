@@ -0,0 +1,460 @@
+import io
+import math
+import random
+import re
+import sys
+from dataclasses import replace
+from functools import lru_cache
+from typing import Any, Optional
+
+import fitz
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+
+from pdf_generator import FlyerData, StaticAsset, draw_flyer, generate_pdf
+from text_metrics import string_width
+
+# MuPDF's built-in base-14 replacements: the same outlines fitz uses when it
+# rasterizes our PDFs, so glyph shapes match the PDF preview.
+_FITZ_FONTS = {
+    "Helvetica": "helv",
+    "Helvetica-Bold": "hebo",
+    "ZapfDingbats": "zadb",
+}
+_ASSET_RASTERS: dict[tuple[str, int, int], Image.Image] = {}
+_ASSET_RASTERS_MAX = 256
+
+
+@lru_cache(maxsize=None)
+def _font_buffer(font_name: str) -> bytes:
+    return fitz.Font(_FITZ_FONTS.get(font_name, "helv")).buffer
+
+
+@lru_cache(maxsize=256)
+def _pil_font(font_name: str, px_size: float) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(io.BytesIO(_font_buffer(font_name)), px_size)
+
+
+def _text_runs(text: str, font_name: str) -> list[tuple[str, str]]:
+    # reportlab falls back to ZapfDingbats for characters outside WinAnsi
+    # (the ✓/✗ in the feature row); mirror that split.
+    runs: list[tuple[str, str]] = []
+    for char in text:
+        try:
+            char.encode("cp1252")
+            run_font = font_name
+        except UnicodeEncodeError:
+            run_font = "ZapfDingbats"
+        if runs and runs[-1][1] == run_font:
+            runs[-1] = (runs[-1][0] + char, run_font)
+        else:
+            runs.append((char, run_font))
+    return runs
+
+
+def _rgb(color: Any) -> tuple[int, int, int]:
+    return (round(color.red * 255), round(color.green * 255), round(color.blue * 255))
+
+
+class _ClipPath:
+    def __init__(self) -> None:
+        self.rects: list[tuple[float, float, float, float]] = []
+
+    def rect(self, x: float, y: float, w: float, h: float) -> None:
+        self.rects.append((x, y, w, h))
+
+
+class RasterCanvas:
+    # Implements the subset of reportlab's Canvas API that draw_flyer uses,
+    # painting straight into a Pillow RGB image at ``dpi``. Clipping is
+    # rectangular (the only kind the flyer uses) and applies to fills and
+    # images.
+    def __init__(self, dpi: float, pagesize: tuple[float, float] = A4) -> None:
+        self.dpi = dpi
+        self.k = dpi / 72.0
+        self.page_w, self.page_h = pagesize
+        self.size = (math.ceil(self.page_w * self.k), math.ceil(self.page_h * self.k))
+        self.image = Image.new("RGB", self.size, (255, 255, 255))
+        self._draw = ImageDraw.Draw(self.image)
+        self._fontname = "Helvetica"
+        self._fontsize = 12.0
+        self._fill: Any = None
+        self._stroke: Any = None
+        self._line_width = 1.0
+        self._dash: Optional[list[float]] = None
+        self._clip: Optional[tuple[int, int, int, int]] = None
+        self._stack: list[tuple] = []
+
+    # -- state ---------------------------------------------------------------
+
+    def stringWidth(self, text: str, font_name: str, font_size: float) -> float:
+        return string_width(text, font_name, font_size)
+
+    def setFillColor(self, color: Any) -> None:
+        self._fill = color
+
+    def setStrokeColor(self, color: Any) -> None:
+        self._stroke = color
+
+    def setLineWidth(self, width: float) -> None:
+        self._line_width = width
+
+    def setDash(self, array: Any = (), phase: float = 0) -> None:
+        if isinstance(array, (int, float)):
+            array = (array, phase)
+        self._dash = [float(v) for v in array] or None
+
+    def setFont(self, font_name: str, font_size: float, leading: Optional[float] = None) -> None:
+        self._fontname = font_name
+        self._fontsize = font_size
+
+    def saveState(self) -> None:
+        self._stack.append(
+            (self._fontname, self._fontsize, self._fill, self._stroke, self._line_width, self._dash, self._clip)
+        )
+
+    def restoreState(self) -> None:
+        (
+            self._fontname,
+            self._fontsize,
+            self._fill,
+            self._stroke,
+            self._line_width,
+            self._dash,
+            self._clip,
+        ) = self._stack.pop()
+
+    def beginPath(self) -> _ClipPath:
+        return _ClipPath()
+
+    def clipPath(self, path: _ClipPath, stroke: int = 0, fill: int = 0) -> None:
+        for x, y, w, h in path.rects:
+            box = self._px_box(x, y, w, h)
+            if self._clip is not None:
+                box = (
+                    max(box[0], self._clip[0]),
+                    max(box[1], self._clip[1]),
+                    min(box[2], self._clip[2]),
+                    min(box[3], self._clip[3]),
+                )
+            self._clip = box
+
+    def showPage(self) -> None:
+        pass
+
+    def save(self) -> None:
+        pass
+
+    # -- geometry ------------------------------------------------------------
+
+    def _px_box(self, x: float, y: float, w: float, h: float) -> tuple[int, int, int, int]:
+        # PDF user space (points, origin bottom-left) to a pixel box
+        # [left, top, right, bottom) on the raster.
+        left = round(x * self.k)
+        right = round((x + w) * self.k)
+        top = round((self.page_h - (y + h)) * self.k)
+        bottom = round((self.page_h - y) * self.k)
+        return (min(left, right), min(top, bottom), max(left, right), max(top, bottom))
+
+    def _px_point(self, x: float, y: float) -> tuple[float, float]:
+        return (x * self.k, (self.page_h - y) * self.k)
+
+    def _clipped(self, box: tuple[int, int, int, int]) -> Optional[tuple[int, int, int, int]]:
+        bounds = self._clip or (0, 0, self.size[0], self.size[1])
+        left = max(box[0], bounds[0], 0)
+        top = max(box[1], bounds[1], 0)
+        right = min(box[2], bounds[2], self.size[0])
+        bottom = min(box[3], bounds[3], self.size[1])
+        if right <= left or bottom <= top:
+            return None
+        return (left, top, right, bottom)
+
+    # -- drawing -------------------------------------------------------------
+
+    def rect(self, x: float, y: float, w: float, h: float, stroke: int = 1, fill: int = 0) -> None:
+        box = self._px_box(x, y, w, h)
+        if fill and self._fill is not None:
+            target = self._clipped(box)
+            if target is not None:
+                alpha = getattr(self._fill, "alpha", 1)
+                size = (target[2] - target[0], target[3] - target[1])
+                if alpha >= 1:
+                    self.image.paste(_rgb(self._fill), target)
+                else:
+                    self.image.paste(
+                        Image.new("RGB", size, _rgb(self._fill)),
+                        target[:2],
+                        Image.new("L", size, round(alpha * 255)),
+                    )
+        if stroke and self._stroke is not None:
+            left, top, right, bottom = box
+            corners = [(left, top), (right, top), (right, bottom), (left, bottom), (left, top)]
+            for start, end in zip(corners, corners[1:]):
+                self._stroke_segment(start, end)
+
+    def line(self, x1: float, y1: float, x2: float, y2: float) -> None:
+        if self._stroke is None:
+            return
+        self._stroke_segment(self._px_point(x1, y1), self._px_point(x2, y2))
+
+    def _stroke_segment(self, start: tuple[float, float], end: tuple[float, float]) -> None:
+        width = max(1, round(self._line_width * self.k))
+        color = _rgb(self._stroke)
+        if not self._dash:
+            self._draw.line([start, end], fill=color, width=width)
+            return
+        length = math.hypot(end[0] - start[0], end[1] - start[1])
+        if length == 0:
+            return
+        dx = (end[0] - start[0]) / length
+        dy = (end[1] - start[1]) / length
+        pattern = [max(0.5, v * self.k) for v in self._dash]
+        pos = 0.0
+        index = 0
+        while pos < length:
+            seg = min(pattern[index % len(pattern)], length - pos)
+            if index % 2 == 0:
+                a = (start[0] + dx * pos, start[1] + dy * pos)
+                b = (start[0] + dx * (pos + seg), start[1] + dy * (pos + seg))
+                self._draw.line([a, b], fill=color, width=width)
+            pos += seg
+            index += 1
+
+    def _draw_text(self, x: float, y: float, text: str) -> None:
+        if not text or self._fill is None:
+            return
+        color = _rgb(self._fill)
+        size = self._fontsize
+        _, baseline = self._px_point(x, y)
+        for run, run_font in _text_runs(text, self._fontname):
+            font = _pil_font(run_font, size * self.k)
+            # Place every word at its AFM position so hinted advances in the
+            # raster font never drift away from the PDF layout.
+            for piece in re.split(r"( +)", run):
+                if not piece:
+                    continue
+                if not piece.isspace():
+                    self._draw.text((x * self.k, baseline), piece, font=font, fill=color, anchor="ls")
+                x += string_width(piece, run_font, size)
+
+    def drawString(self, x: float, y: float, text: str, *args: Any, **kwargs: Any) -> None:
+        self._draw_text(x, y, text)
+
+    def drawRightString(self, x: float, y: float, text: str, *args: Any, **kwargs: Any) -> None:
+        self._draw_text(x - self.stringWidth(text, self._fontname, self._fontsize), y, text)
+
+    def drawCentredString(self, x: float, y: float, text: str, *args: Any, **kwargs: Any) -> None:
+        self._draw_text(x - self.stringWidth(text, self._fontname, self._fontsize) / 2, y, text)
+
+    def _paste(self, img: Image.Image, box: tuple[int, int, int, int]) -> None:
+        target = self._clipped(box)
+        if target is None:
+            return
+        crop = (target[0] - box[0], target[1] - box[1], target[2] - box[0], target[3] - box[1])
+        if crop != (0, 0, img.width, img.height):
+            img = img.crop(crop)
+        if img.mode == "RGBA":
+            self.image.paste(img, target[:2], img)
+        else:
+            self.image.paste(img, target[:2])
+
+    def drawImage(
+        self,
+        image: Any,
+        x: float,
+        y: float,
+        width: Optional[float] = None,
+        height: Optional[float] = None,
+        mask: Any = None,
+        *args: Any,
+        **kwargs: Any,
+    ) -> None:
+        if isinstance(image, ImageReader):
+            img = image._image
+        elif isinstance(image, Image.Image):
+            img = image
+        else:
+            img = Image.open(image)
+        if width is None or height is None:
+            width, height = img.size
+        box = self._px_box(x, y, width, height)
+        size = (max(1, box[2] - box[0]), max(1, box[3] - box[1]))
+        img.draft("RGB", size)
+        has_alpha = img.mode in {"RGBA", "LA", "PA"} or (img.mode == "P" and "transparency" in img.info)
+        img = img.convert("RGBA" if has_alpha and mask is not None else "RGB")
+        self._paste(img.resize(size, Image.BILINEAR, reducing_gap=2.0), box)
+
+    def drawAsset(self, asset: StaticAsset, x: float, y: float, w: float, h: float) -> None:
+        box = self._px_box(x, y, w, h)
+        size = (max(1, box[2] - box[0]), max(1, box[3] - box[1]))
+        key = (asset.name, size[0], size[1])
+        raster = _ASSET_RASTERS.get(key)
+        if raster is None:
+            if len(_ASSET_RASTERS) >= _ASSET_RASTERS_MAX:
+                _ASSET_RASTERS.clear()
+            source = asset.reader._image
+            source = source.convert("RGBA" if "A" in source.getbands() else "RGB")
+            raster = source.resize(size, Image.LANCZOS)
+            _ASSET_RASTERS[key] = raster
+        self._paste(raster, box)
+
+    def to_png(self) -> bytes:
+        buffer = io.BytesIO()
+        self.image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+
+def render_raster(data: FlyerData, dpi: float) -> Image.Image:
+    rc = RasterCanvas(dpi)
+    draw_flyer(rc, data, image_dpi=None)
+    return rc.image
+
+
+def pixel_difference(a: Image.Image, b: Image.Image, tolerance: int = 64, reduce: int = 4) -> dict:
+    # Both images are box-reduced first: glyph hinting and anti-aliasing put
+    # edges a sub-pixel apart, which is noise here; a shifted or missing
+    # element still shows up after the reduction.
+    a = a.convert("RGB")
+    b = b.convert("RGB")
+    if a.size != b.size:
+        return {"size_match": False, "mean": None, "max": None, "over_tolerance": None}
+    if reduce > 1:
+        a = a.reduce(reduce)
+        b = b.reduce(reduce)
+    diff = ImageChops.difference(a, b).convert("L")
+    histogram = diff.histogram()
+    total = a.width * a.height
+    mean = sum(value * count for value, count in enumerate(histogram)) / total
+    return {
+        "size_match": True,
+        "mean": round(mean, 4),
+        "max": max(value for value, count in enumerate(histogram) if count),
+        "over_tolerance": round(sum(histogram[tolerance + 1:]) / total, 6),
+    }
+
+
+def compare_with_fitz(data: FlyerData, dpi: float = 120) -> dict:
+    pdf_buffer = io.BytesIO()
+    generate_pdf(data, pdf_buffer, image_dpi=None)
+    doc = fitz.open(stream=pdf_buffer.getvalue(), filetype="pdf")
+    try:
+        pix = doc.load_page(0).get_pixmap(dpi=dpi, alpha=False)
+        reference = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    finally:
+        doc.close()
+    return pixel_difference(reference, render_raster(data, dpi))
+
+
+# Thresholds for the raster backend to count as visually equivalent to fitz:
+# anti-aliasing and hinting differ, so only the share of clearly different
+# pixels and the average error are bounded.
+MAX_MEAN_DIFFERENCE = 2.0
+MAX_OVER_TOLERANCE = 0.003
+
+
+def _sample_photo() -> bytes:
+    photo = io.BytesIO()
+    gradient = Image.linear_gradient("L").resize((1600, 1000))
+    Image.merge("RGB", (gradient, gradient.rotate(90, expand=False), gradient.transpose(Image.FLIP_LEFT_RIGHT))).save(
+        photo, format="JPEG", quality=85
+    )
+    return photo.getvalue()
+
+
+def _sample_qr() -> bytes:
+    # Hard-edged black and white modules, like a real code.
+    modules = Image.frombytes("1", (29, 29), bytes(random.Random(7).getrandbits(8) for _ in range(4 * 29)))
+    qr = io.BytesIO()
+    modules.convert("L").resize((290, 290), Image.NEAREST).save(qr, format="PNG")
+    return qr.getvalue()
+
+
+def _sample_transparent_png() -> bytes:
+    # A photo-like gradient inside a transparent frame, with a soft edge.
+    gradient = Image.linear_gradient("L").resize((800, 600))
+    img = Image.merge("RGBA", (gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT), gradient.rotate(90), gradient))
+    alpha = Image.new("L", img.size, 0)
+    ImageDraw.Draw(alpha).ellipse((80, 60, 720, 540), fill=255)
+    img.putalpha(alpha)
+    png = io.BytesIO()
+    img.save(png, format="PNG")
+    return png.getvalue()
+
+
+def _sample_flyer() -> FlyerData:
+    images = {}
+    for i in range(1, 5):
+        images.update(
+            {
+                f"imagen{i}_escala": 1.0,
+                f"imagen{i}_offset_x": 0.0,
+                f"imagen{i}_offset_y": 0.0,
+                f"imagen{i}_modo": ("contain", "cover", "expand", "custom")[i - 1],
+                f"imagen{i}_custom_ancho": 80.0,
+                f"imagen{i}_custom_alto": 120.0,
+            }
+        )
+    photo_bytes = _sample_photo()
+    return FlyerData(
+        texto1="Venta",
+        color_texto1="#ffffff",
+        texto_marca="",
+        color_texto_marca="#ffffff",
+        texto2="Calle Mayor 1",
+        color_texto2="#000000",
+        texto2_fondo=None,
+        texto3="120 m2 construidos",
+        color_texto3="#000000",
+        texto4="Rebajado",
+        color_texto4="#ffffff",
+        rebajado=True,
+        habitaciones=3,
+        banos=2,
+        jardin=True,
+        garaje=False,
+        piscina=True,
+        borde_caracteristicas="dashed",
+        color_borde_caracteristicas="#111111",
+        descripcion="Luminoso piso reformado con terraza y vistas. " * 12,
+        color_descripcion="#000000",
+        descripcion_tamano=9.0,
+        precio="154.900€",
+        color_precio="#b9cdb8",
+        energia="C",
+        escala_imagenes=0.93,
+        imagen1=photo_bytes,
+        imagen2=photo_bytes,
+        imagen3=photo_bytes,
+        imagen4=photo_bytes,
+        qr_imagen=None,
+        **images,
+    )
+
+
+def _sample_flyers() -> dict[str, FlyerData]:
+    # The photos alone miss the paths that differ most between backends:
+    # the QR's hard edges, the image behind texto2 and alpha compositing.
+    base = _sample_flyer()
+    transparent = _sample_transparent_png()
+    return {
+        "fotos": base,
+        "qr": replace(base, qr_imagen=_sample_qr()),
+        "texto2_fondo": replace(base, texto2_fondo=_sample_photo(), color_texto2="#ffffff"),
+        "png_transparente": replace(base, imagen1=transparent, imagen2=transparent, imagen3=transparent, imagen4=transparent),
+    }
+
+
+if __name__ == "__main__":
+    # python -m server.raster_canvas  -> compares both backends on a few
+    # samples and fails if any of them is over the thresholds.
+    ok = True
+    for name, data in _sample_flyers().items():
+        result = compare_with_fitz(data)
+        print(name, result)
+        ok = ok and (
+            result["size_match"]
+            and result["mean"] <= MAX_MEAN_DIFFERENCE
+            and result["over_tolerance"] <= MAX_OVER_TOLERANCE
+        )
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,227 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, TypeVar, Union
+
+T = TypeVar("T")
+
+# A full disk cache is trimmed to this share of its budget, so the writes
+# right after an eviction do not each trigger another directory scan.
+DISK_EVICT_TARGET = 0.9
+
+
+class RenderCache(ABC):
+    backend = "none"
+    # Whether get/set do file I/O; async callers then run them in a thread.
+    blocking = False
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max(0, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]: ...
+
+    @abstractmethod
+    def set(self, key: str, data: bytes, ttl: Optional[float] = None) -> None: ...
+
+    @abstractmethod
+    def usage(self) -> tuple[int, int]: ...
+
+    def stats(self) -> dict:
+        entries, held = self.usage()
+        lookups = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": entries,
+            "bytes": held,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class MemoryCache(RenderCache):
+    # Per-process LRU bounded by the total size of the cached values, so a
+    # handful of large PDFs cannot crowd out memory the way a count limit
+    # would. Entries may carry a TTL (``ttl`` on set, else the default).
+    backend = "memory"
+
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None) -> None:
+        super().__init__(max_bytes)
+        self.ttl = ttl if ttl and ttl > 0 else None
+        self._entries: "OrderedDict[str, tuple[bytes, Optional[float]]]" = OrderedDict()
+        self._bytes = 0
+
+    def _drop(self, key: str) -> None:
+        data, _ = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        data, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes, ttl: Optional[float] = None) -> None:
+        if key in self._entries:
+            self._drop(key)
+        if len(data) > self.max_bytes:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (data, expires_at)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def usage(self) -> tuple[int, int]:
+        return len(self._entries), self._bytes
+
+
+class DiskCache(RenderCache):
+    # Sharded directory shared by every worker on the node and kept across
+    # restarts. Writes go through a temp file + os.replace so readers never
+    # see partial entries; reads refresh the mtime, which drives LRU eviction
+    # once the files exceed ``max_bytes`` in total. Counters are per
+    # process; TTLs are not supported here, size is the only bound.
+    backend = "disk"
+    blocking = True
+
+    def __init__(self, root: Path, max_bytes: int) -> None:
+        super().__init__(max_bytes)
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Entries and size on disk as of the last scan plus this process's
+        # writes since. Only when the size crosses ``max_bytes`` is the
+        # directory scanned again, which also picks up what other processes
+        # wrote in between.
+        self._lock = threading.Lock()
+        entries = self._scan()
+        self._count = len(entries)
+        self._bytes = sum(size for _, size, _, _ in entries)
+
+    def _path(self, key: str) -> Path:
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.root / name[:2] / name
+
+    def contains(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes, ttl: Optional[float] = None) -> None:
+        path = self._path(key)
+        if path.exists():
+            os.utime(path)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        with self._lock:
+            self._count += 1
+            self._bytes += len(data)
+            if self._bytes > self.max_bytes:
+                self._evict(keep=path.name)
+
+    def _scan(self) -> list[tuple[float, int, str, str]]:
+        entries = []
+        for shard in self.root.iterdir():
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard):
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path, entry.name))
+        return entries
+
+    def usage(self) -> tuple[int, int]:
+        return self._count, self._bytes
+
+    def _evict(self, keep: str) -> None:
+        entries = self._scan()
+        total = sum(size for _, size, _, _ in entries)
+        self._count = len(entries)
+        self._bytes = total
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * DISK_EVICT_TARGET)
+        entries.sort()
+        for _, size, path, name in entries:
+            if total <= target:
+                break
+            if name == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            else:
+                self.evictions += 1
+            self._count -= 1
+            total -= size
+        self._bytes = total
+
+
+def env_int(name: str, default: T) -> Union[int, T]:
+    # Unset, empty or malformed values fall back to ``default``, which may be
+    # None for settings that have no fixed default.
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def cache_from_env() -> RenderCache:
+    backend = os.environ.get("NEWHOME_CACHE_BACKEND", "memory").strip().lower()
+    if backend == "disk":
+        root = os.environ.get("NEWHOME_CACHE_DIR") or str(Path(tempfile.gettempdir()) / "newhome_cache")
+        return DiskCache(Path(root), env_int("NEWHOME_CACHE_MAX_MB", 1024) * 1024 * 1024)
+    return MemoryCache(
+        env_int("NEWHOME_CACHE_MAX_MB", 128) * 1024 * 1024,
+        ttl=env_int("NEWHOME_CACHE_TTL", 0),
+    )
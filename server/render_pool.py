@@ -0,0 +1,376 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, fields, replace
+from typing import Any, Callable, Optional
+
+import fitz
+from PIL import Image
+
+from pdf_generator import (
+    PRINT_IMAGE_DPI,
+    SCREEN_IMAGE_DPI,
+    FlyerData,
+    draw_flyer,
+    generate_catalog,
+    generate_pdf,
+    load_static_assets,
+    set_stage_observer,
+)
+from server.metrics import RENDER_ERRORS, RENDER_SECONDS, RENDERS, collect_stages, observe_stages, record_stage, stage
+from server.raster_canvas import RasterCanvas
+from server.render_cache import env_int
+
+IMAGE_SLOTS = ("imagen1", "imagen2", "imagen3", "imagen4", "qr_imagen", "texto2_fondo")
+PREVIEW_DPI = 120
+PREVIEW_MODES = ("pdf", "layered", "raster")
+PREVIEW_FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+PREVIEW_QUALITY = 80
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name) or default)
+    except ValueError:
+        return default
+
+
+PDF_IMAGE_DPI = _env_float("NEWHOME_PDF_IMAGE_DPI", PRINT_IMAGE_DPI)
+SPOOL_MAX_BYTES = int(_env_float("NEWHOME_SPOOL_MAX_MB", 8) * 1024 * 1024)
+SPOOL_DIR = os.environ.get("NEWHOME_SPOOL_DIR") or None
+PREVIEW_MODE = os.environ.get("NEWHOME_PREVIEW_MODE", "pdf").strip().lower()
+if PREVIEW_MODE not in PREVIEW_MODES:
+    PREVIEW_MODE = "pdf"
+
+# Also runs in every worker process, which imports this module to unpickle
+# the render functions.
+set_stage_observer(record_stage)
+
+
+@dataclass(frozen=True)
+class RenderJob:
+    # Image slots in ``data`` hold the raw upload bytes so the job can be
+    # pickled into a worker process and rendered without touching disk.
+    data: FlyerData
+
+
+@dataclass(frozen=True)
+class PreviewOptions:
+    # Resolution and encoding of a preview image. Each variant is cached on
+    # its own, so a client can ask for a small, cheap frame while the user
+    # types and a sharp one afterwards.
+    dpi: float = PREVIEW_DPI
+    format: str = "png"
+    quality: int = PREVIEW_QUALITY
+
+    @property
+    def media_type(self) -> str:
+        return PREVIEW_FORMATS[self.format]
+
+    @property
+    def variant(self) -> str:
+        if self.format == "png":
+            return f"png@{self.dpi:g}"
+        return f"{self.format}@{self.dpi:g}q{self.quality}"
+
+
+class RenderQueueFull(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class RenderedDocument:
+    # Output of a render that may be too large to pass around in memory:
+    # either ``data`` or a temp file at ``path`` that the receiver owns and
+    # must delete. Only the path crosses the process boundary.
+    size: int
+    data: Optional[bytes] = None
+    path: Optional[str] = None
+
+
+class SpooledOutput:
+    # Write target for a render: kept in memory up to ``max_bytes``, moved to
+    # a named temp file beyond that.
+    def __init__(self, max_bytes: int = SPOOL_MAX_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._file = None
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        if self._file is None and self.size + len(data) > self.max_bytes:
+            self._file = tempfile.NamedTemporaryFile(prefix="newhome_", suffix=".spool", dir=SPOOL_DIR, delete=False)
+            self._file.write(self._buffer.getbuffer())
+            self._buffer = None
+        (self._file or self._buffer).write(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def result(self) -> RenderedDocument:
+        if self._file is None:
+            return RenderedDocument(size=self.size, data=self._buffer.getvalue())
+        self._file.close()
+        return RenderedDocument(size=self.size, path=self._file.name)
+
+
+def fingerprint(data: FlyerData, image_hashes: dict[str, Optional[str]]) -> str:
+    form = {f.name: getattr(data, f.name) for f in fields(data) if f.name not in IMAGE_SLOTS}
+    files = {slot: image_hashes.get(slot) for slot in IMAGE_SLOTS}
+    payload = json.dumps({"form": form, "files": files}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def build_job(data: FlyerData, uploads: dict[str, Optional[bytes]]) -> RenderJob:
+    images = {slot: uploads.get(slot) or None for slot in IMAGE_SLOTS}
+    return RenderJob(data=replace(data, **images))
+
+
+def render_pdf(job: RenderJob, image_dpi: Optional[float] = PDF_IMAGE_DPI) -> bytes:
+    pdf_buffer = io.BytesIO()
+    generate_pdf(job.data, pdf_buffer, image_dpi=image_dpi)
+    return pdf_buffer.getvalue()
+
+
+def render_pdf_document(job: RenderJob, image_dpi: Optional[float] = PDF_IMAGE_DPI) -> RenderedDocument:
+    output = SpooledOutput()
+    generate_pdf(job.data, output, image_dpi=image_dpi)
+    return output.result()
+
+
+def render_catalog(jobs: list[RenderJob], image_dpi: Optional[float] = PDF_IMAGE_DPI) -> RenderedDocument:
+    # Jobs that use the same stored image should carry the same bytes object;
+    # pickling keeps it shared, so each photo crosses into the worker once.
+    output = SpooledOutput()
+    generate_catalog((job.data for job in jobs), output, image_dpi=image_dpi)
+    return output.result()
+
+
+def encode_preview(image: Image.Image, options: PreviewOptions) -> bytes:
+    buffer = io.BytesIO()
+    with stage("encode"):
+        if options.format == "jpeg":
+            image.save(buffer, format="JPEG", quality=options.quality)
+        elif options.format == "webp":
+            image.save(buffer, format="WEBP", quality=options.quality, method=2)
+        else:
+            image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _encode_pixmap(pix: fitz.Pixmap, options: PreviewOptions) -> bytes:
+    if options.format == "png":
+        with stage("encode"):
+            return pix.tobytes("png")
+    return encode_preview(Image.frombytes("RGB", (pix.width, pix.height), pix.samples), options)
+
+
+def _page_pixmap(page: fitz.Page, dpi: float, alpha: bool) -> fitz.Pixmap:
+    # A matrix rather than ``dpi=``, which only takes whole numbers; preview
+    # widths map to fractional resolutions.
+    zoom = dpi / 72.0
+    with stage("rasterize"):
+        return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=alpha)
+
+
+def rasterize_pdf(pdf_bytes: bytes, options: PreviewOptions = PreviewOptions()) -> bytes:
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        pix = _page_pixmap(doc.load_page(0), options.dpi, alpha=False)
+        return _encode_pixmap(pix, options)
+    finally:
+        doc.close()
+
+
+# Display lists of recently zoomed flyers, per process. Zooming asks for many
+# tiles of the same page; replaying the list skips parsing the PDF and
+# interpreting the page again, so a tile costs only its own pixels.
+_TILE_PAGES: dict[str, tuple[fitz.Document, fitz.DisplayList]] = {}
+_TILE_PAGES_MAX = 4
+_TILE_LOCK = threading.Lock()
+
+
+def _tile_page(cache_key: str, pdf_bytes: Optional[bytes]) -> Optional[fitz.DisplayList]:
+    entry = _TILE_PAGES.pop(cache_key, None)
+    if entry is None:
+        if pdf_bytes is None:
+            return None
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        entry = (doc, doc.load_page(0).get_displaylist())
+        while len(_TILE_PAGES) >= _TILE_PAGES_MAX:
+            old_doc, _ = _TILE_PAGES.pop(next(iter(_TILE_PAGES)))
+            old_doc.close()
+    _TILE_PAGES[cache_key] = entry
+    return entry[1]
+
+
+def render_tile(
+    cache_key: str,
+    pdf_bytes: Optional[bytes],
+    region: tuple[float, float, float, float],
+    options: PreviewOptions,
+) -> Optional[bytes]:
+    # ``region`` is x, y, width and height as fractions of the page, from the
+    # top left corner. Callers first pass no ``pdf_bytes``, so a tile of a
+    # page this process already holds does not ship the whole PDF; None means
+    # the page is not here and the call has to be repeated with the PDF.
+    x, y, w, h = region
+    zoom = options.dpi / 72.0
+    with _TILE_LOCK:
+        display_list = _tile_page(cache_key, pdf_bytes)
+        if display_list is None:
+            return None
+        page = display_list.rect
+        clip = fitz.Rect(
+            page.x0 + x * page.width,
+            page.y0 + y * page.height,
+            page.x0 + (x + w) * page.width,
+            page.y0 + (y + h) * page.height,
+        )
+        with stage("rasterize"):
+            pix = display_list.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+    return _encode_pixmap(pix, options)
+
+
+def render_preview(job: RenderJob, options: PreviewOptions = PreviewOptions()) -> tuple[bytes, bytes]:
+    # The PDF is rendered at print resolution so the caller can cache it as
+    # the download for the same state.
+    pdf_bytes = render_pdf(job)
+    return pdf_bytes, rasterize_pdf(pdf_bytes, options)
+
+
+# Raster of the page chrome shared by every flyer, per DPI and per process.
+# Preview widths are free-form, so only the most recent few are kept.
+_STATIC_LAYERS: dict[float, Image.Image] = {}
+_STATIC_LAYERS_MAX = 8
+_STATIC_LOCK = threading.Lock()
+
+
+def _rasterize_layer(pdf_bytes: bytes, dpi: float, alpha: bool) -> Image.Image:
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        pix = _page_pixmap(doc.load_page(0), dpi, alpha=alpha)
+        # MuPDF hands out premultiplied samples when alpha is requested.
+        mode = "RGBa" if alpha else "RGB"
+        return Image.frombytes(mode, (pix.width, pix.height), pix.samples).convert("RGBA")
+    finally:
+        doc.close()
+
+
+def _static_layer(data: FlyerData, dpi: float) -> Image.Image:
+    # The lock matters with the thread pool; it also keeps concurrent misses
+    # for one DPI from rendering the chrome twice.
+    with _STATIC_LOCK:
+        layer = _STATIC_LAYERS.pop(dpi, None)
+        if layer is None:
+            pdf_buffer = io.BytesIO()
+            generate_pdf(data, pdf_buffer, layers="static")
+            layer = _rasterize_layer(pdf_buffer.getvalue(), dpi, alpha=False)
+            while len(_STATIC_LAYERS) >= _STATIC_LAYERS_MAX:
+                del _STATIC_LAYERS[next(iter(_STATIC_LAYERS))]
+        _STATIC_LAYERS[dpi] = layer
+        return layer
+
+
+def render_layered_preview(job: RenderJob, options: PreviewOptions = PreviewOptions()) -> bytes:
+    # Only the per-flyer content goes through reportlab and fitz; it is
+    # rendered on a transparent page and composited over the cached chrome,
+    # which keeps the certificate, and the logo unless a long title runs
+    # under it, out of the PDF.
+    pdf_buffer = io.BytesIO()
+    generate_pdf(job.data, pdf_buffer, image_dpi=max(float(options.dpi), SCREEN_IMAGE_DPI), layers="dynamic")
+    dynamic = _rasterize_layer(pdf_buffer.getvalue(), options.dpi, alpha=True)
+    page = Image.alpha_composite(_static_layer(job.data, options.dpi), dynamic).convert("RGB")
+    return encode_preview(page, options)
+
+
+def render_raster_preview(job: RenderJob, options: PreviewOptions = PreviewOptions()) -> bytes:
+    # Draws the flyer straight onto a Pillow image, skipping reportlab's PDF
+    # serialization and the fitz parse/rasterize round trip.
+    rc = RasterCanvas(options.dpi)
+    with stage("draw"):
+        draw_flyer(rc, job.data, image_dpi=None)
+    return encode_preview(rc.image, options)
+
+
+class RenderPool:
+    def __init__(self, mode: str = "process", workers: Optional[int] = None, queue_size: int = 16) -> None:
+        self.mode = mode if mode in {"process", "thread"} else "process"
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.queue_size = max(0, queue_size)
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    def _ensure_executor(self) -> Executor:
+        if self._executor is None:
+            if self.mode == "thread":
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="newhome-render")
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=load_static_assets)
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        # Reject instead of queueing without bound: once every worker is busy
+        # and the waiting room is full the caller gets an immediate error.
+        name = getattr(fn, "__name__", "render")
+        if self._pending >= self.capacity:
+            RENDER_ERRORS.inc(function=name, type=RenderQueueFull.__name__)
+            raise RenderQueueFull()
+        executor = self._ensure_executor()
+        self._pending += 1
+        RENDERS.inc(function=name)
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result, stages = await loop.run_in_executor(executor, collect_stages, fn, *args)
+        except BrokenExecutor as exc:
+            # A worker died (killed, out of memory, crashed in native code) and
+            # the executor refuses all work from now on. The renders that were
+            # in it fail; the next call starts a fresh one.
+            RENDER_ERRORS.inc(function=name, type=type(exc).__name__)
+            self._discard_executor(executor)
+            raise
+        except Exception as exc:
+            RENDER_ERRORS.inc(function=name, type=type(exc).__name__)
+            raise
+        finally:
+            self._pending -= 1
+            RENDER_SECONDS.observe(time.perf_counter() - start, function=name)
+        observe_stages(stages)
+        return result
+
+    def _discard_executor(self, executor: Executor) -> None:
+        # Concurrent failures report the same broken executor; only the first
+        # replaces it.
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+def pool_from_env() -> RenderPool:
+    return RenderPool(
+        mode=os.environ.get("NEWHOME_RENDER_MODE", "process").strip().lower(),
+        workers=env_int("NEWHOME_RENDER_WORKERS", None),
+        queue_size=env_int("NEWHOME_RENDER_QUEUE", 16) or 0,
+    )
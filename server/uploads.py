@@ -0,0 +1,160 @@
+import hashlib
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from server.metrics import UPLOAD_BYTES, record_stage
+from server.render_cache import env_int
+
+UPLOAD_MAX_FILE_BYTES = env_int("NEWHOME_UPLOAD_MAX_FILE_MB", 25) * 1024 * 1024
+UPLOAD_MAX_REQUEST_BYTES = env_int("NEWHOME_UPLOAD_MAX_REQUEST_MB", 100) * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 64 * 1024
+
+# Leading bytes of the formats Pillow decodes for us; anything else is
+# rejected before the rest of the file is read.
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",
+    b"II*\x00",  # TIFF, little endian
+    b"MM\x00*",  # TIFF, big endian
+)
+INVALID_IMAGE_DETAIL = "Alguna imagen no es válida o está dañada. Usa JPG, PNG o WEBP."
+
+
+def _megabytes(value: int) -> str:
+    return f"{value / (1024 * 1024):g}"
+
+
+def looks_like_image(header: bytes) -> bool:
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return True
+    return header.startswith(IMAGE_SIGNATURES)
+
+
+@dataclass(frozen=True)
+class IngestedUpload:
+    data: bytes
+    sha256: str
+
+
+class UploadBudget:
+    # Byte limits for the files of one request: each file on its own and all
+    # of them together.
+    def __init__(
+        self,
+        max_file_bytes: int = UPLOAD_MAX_FILE_BYTES,
+        max_request_bytes: int = UPLOAD_MAX_REQUEST_BYTES,
+    ) -> None:
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.used = 0
+
+    def check_file(self, size: int) -> None:
+        if size > self.max_file_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Cada imagen puede ocupar como máximo {_megabytes(self.max_file_bytes)} MB.",
+            )
+        if self.used + size > self.max_request_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Las imágenes pueden ocupar como máximo {_megabytes(self.max_request_bytes)} MB en total.",
+            )
+
+    def consume(self, file_total: int, amount: int) -> None:
+        self.check_file(file_total + amount)
+        self.used += amount
+
+
+async def ingest_upload(upload: Optional[UploadFile], budget: UploadBudget) -> Optional[IngestedUpload]:
+    # Reads an upload chunk by chunk: the size reported by the multipart
+    # parser and the first bytes are checked before anything is kept, and
+    # the SHA-256 is computed on the way instead of in a second pass.
+    if not upload:
+        return None
+    if upload.size is not None:
+        budget.check_file(upload.size)
+    digest = hashlib.sha256()
+    chunks: list[bytes] = []
+    total = 0
+    start = time.perf_counter()
+    hashing = 0.0
+    while chunk := await upload.read(UPLOAD_CHUNK_BYTES):
+        if not total and not looks_like_image(chunk):
+            raise HTTPException(status_code=400, detail=INVALID_IMAGE_DETAIL)
+        budget.consume(total, len(chunk))
+        total += len(chunk)
+        hash_start = time.perf_counter()
+        digest.update(chunk)
+        hashing += time.perf_counter() - hash_start
+        chunks.append(chunk)
+    record_stage("upload_read", time.perf_counter() - start - hashing)
+    record_stage("upload_hash", hashing)
+    UPLOAD_BYTES.inc(total)
+    if not total:
+        return None
+    return IngestedUpload(data=b"".join(chunks), sha256=digest.hexdigest())
+
+
+async def ingest_uploads(uploads: dict[str, Optional[UploadFile]]) -> dict[str, Optional[IngestedUpload]]:
+    budget = UploadBudget()
+    return {slot: await ingest_upload(upload, budget) for slot, upload in uploads.items()}
+
+
+class _RequestTooLarge(HTTPException):
+    # An HTTPException so that FastAPI's body parsing passes it through as a
+    # 413 rather than wrapping it into a generic 400.
+    def __init__(self, max_bytes: int) -> None:
+        super().__init__(status_code=413, detail=f"La petición supera el máximo de {_megabytes(max_bytes)} MB.")
+
+
+class RequestSizeLimitMiddleware:
+    # Caps the request body before the multipart parser spools it: a declared
+    # Content-Length over the limit is refused outright, and a body that
+    # turns out longer while streaming is cut off at the limit.
+    def __init__(self, app, max_bytes: int = UPLOAD_MAX_REQUEST_BYTES) -> None:
+        self.app = app
+        self.max_bytes = max_bytes
+
+    def _too_large(self) -> JSONResponse:
+        return JSONResponse({"detail": _RequestTooLarge(self.max_bytes).detail}, status_code=413)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or self.max_bytes <= 0:
+            await self.app(scope, receive, send)
+            return
+        declared = dict(scope["headers"]).get(b"content-length", b"")
+        if declared.isdigit() and int(declared) > self.max_bytes:
+            await self._too_large()(scope, receive, send)
+            return
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise _RequestTooLarge(self.max_bytes)
+            return message
+
+        async def tracking_send(message) -> None:
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _RequestTooLarge:
+            if started:
+                raise
+            await self._too_large()(scope, receive, send)
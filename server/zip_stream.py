@@ -0,0 +1,32 @@
+import zipfile
+
+
+class ZipStream:
+    # Builds a ZIP incrementally for a streaming response. zipfile sees a
+    # sink without tell/seek, so it writes each entry with a trailing data
+    # descriptor instead of seeking back; whatever it has produced is handed
+    # out by add() and close(), and nothing but the central directory is kept.
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+        self._zip = zipfile.ZipFile(self, mode="w", compression=zipfile.ZIP_STORED)
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def _take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+    def add(self, name: str, data: bytes) -> bytes:
+        # PDFs and PNGs are already compressed, so entries are stored as is.
+        self._zip.writestr(name, data)
+        return self._take()
+
+    def close(self) -> bytes:
+        self._zip.close()
+        return self._take()
@@ -0,0 +1,26 @@
+import io
+from dataclasses import replace
+
+import pytest
+from PIL import Image
+
+from pdf_generator import SCREEN_IMAGE_DPI, load_static_assets
+from server.raster_canvas import _sample_flyer, pixel_difference
+from server.render_pool import PreviewOptions, RenderJob, rasterize_pdf, render_layered_preview, render_pdf
+
+# Only anti-aliasing may differ between the composite and the full page.
+MAX_CHANNEL_DIFFERENCE = 8
+
+
+@pytest.mark.parametrize("texto1", ["Venta", "Espectacular ático dúplex con vistas al mar"])
+def test_layered_preview_matches_full_page(texto1):
+    # A long title runs under the header logo; the logo has to stay on top
+    # as it does in the PDF.
+    load_static_assets()
+    job = RenderJob(data=replace(_sample_flyer(), texto1=texto1))
+    options = PreviewOptions(dpi=120)
+    layered = Image.open(io.BytesIO(render_layered_preview(job, options)))
+    full = Image.open(io.BytesIO(rasterize_pdf(render_pdf(job, image_dpi=SCREEN_IMAGE_DPI), options)))
+    result = pixel_difference(full, layered, reduce=1)
+    assert result["size_match"]
+    assert result["max"] <= MAX_CHANNEL_DIFFERENCE, result
@@ -0,0 +1,151 @@
+import random
+
+from reportlab.lib.units import mm
+
+import pdf_generator
+from pdf_generator import (
+    DESC_FONT_MIN,
+    LAYOUT_MAX_SCALE,
+    LAYOUT_MIN_SCALE,
+    LAYOUT_SCALE_STEP,
+    _layout_scale_range,
+    _safe_description_font_size,
+    _solve_layout,
+)
+from text_metrics import truncate_lines, wrap_text
+
+_WORDS = (
+    "piso casa chalet luminoso reformado terraza vistas al mar cocina amueblada "
+    "dormitorios baños garaje trastero piscina comunitaria jardín privado zona "
+    "tranquila cerca de colegios y comercios calefacción aire acondicionado "
+    "ascensor orientación sur 120m² parcela de 500 metros"
+).split()
+
+
+def _scan_layout(
+    description: str,
+    font_size_setting: float,
+    available_height: float,
+    min_margin: float,
+) -> dict:
+    # Reference: the original linear scan over every candidate, with no wrap
+    # memo.
+    desc_font_size = _safe_description_font_size(font_size_setting)
+    if len(description) > 1000:
+        desc_font_size = max(DESC_FONT_MIN, desc_font_size - 1.0)
+
+    def compute_layout(scale: float, spacing_ratio: float, font_size: float) -> dict:
+        top_gap = 6 * mm * spacing_ratio
+        grid_h = 110 * mm * scale
+        grid_w = pdf_generator.PAGE_W - 20 * mm
+        grid_gap = 4 * mm
+        icon_row_h = 14 * mm * scale
+        grid_to_icons_gap = 12 * mm * spacing_ratio
+        icons_to_desc_gap = 10 * mm * spacing_ratio
+        qr_size = 30 * mm * scale
+        desc_x = 10 * mm + qr_size + 6 * mm
+        desc_w = pdf_generator.PAGE_W - desc_x - 10 * mm
+        line_h = max(3.2 * mm, font_size * 1.3)
+        desc_lines = wrap_text(description, "Helvetica", font_size, desc_w)
+        desc_h = len(desc_lines) * line_h
+        desc_row_h = max(qr_size, desc_h + 2 * mm)
+        block_h = top_gap + grid_h + grid_to_icons_gap + icon_row_h + icons_to_desc_gap + desc_row_h
+        return {
+            "scale": scale,
+            "top_gap": top_gap,
+            "grid_h": grid_h,
+            "grid_w": grid_w,
+            "grid_gap": grid_gap,
+            "icon_row_h": icon_row_h,
+            "grid_to_icons_gap": grid_to_icons_gap,
+            "icons_to_desc_gap": icons_to_desc_gap,
+            "qr_size": qr_size,
+            "desc_x": desc_x,
+            "desc_w": desc_w,
+            "desc_font_size": font_size,
+            "line_h": line_h,
+            "desc_lines": desc_lines,
+            "desc_h": desc_h,
+            "desc_row_h": desc_row_h,
+            "block_h": block_h,
+            "remaining": available_height - block_h,
+        }
+
+    base_layout = compute_layout(1.0, 1.0, desc_font_size)
+    prefer_scale_up = base_layout["remaining"] > 20 * mm
+    start = LAYOUT_MAX_SCALE if prefer_scale_up else 1.0
+    for scale in _layout_scale_range(start, LAYOUT_MIN_SCALE, LAYOUT_SCALE_STEP):
+        candidate = compute_layout(scale, 1.0, desc_font_size)
+        if candidate["remaining"] >= 2 * min_margin:
+            return candidate
+    for scale in _layout_scale_range(1.0, LAYOUT_MIN_SCALE, LAYOUT_SCALE_STEP):
+        candidate = compute_layout(scale, 0.88, desc_font_size)
+        if candidate["remaining"] >= 2 * min_margin:
+            return candidate
+    font_size = desc_font_size
+    while font_size >= DESC_FONT_MIN:
+        candidate = compute_layout(LAYOUT_MIN_SCALE, 0.82, font_size)
+        if candidate["remaining"] >= 2 * min_margin:
+            return candidate
+        font_size -= 0.5
+
+    layout = compute_layout(LAYOUT_MIN_SCALE, 0.80, DESC_FONT_MIN)
+    fixed_part_h = (
+        layout["top_gap"]
+        + layout["grid_h"]
+        + layout["grid_to_icons_gap"]
+        + layout["icon_row_h"]
+        + layout["icons_to_desc_gap"]
+    )
+    max_desc_row_h = max(layout["qr_size"], available_height - fixed_part_h - 2 * min_margin)
+    max_desc_h = max(0.0, max_desc_row_h - 2 * mm)
+    max_lines = max(1, int(max_desc_h // layout["line_h"]))
+    truncated = truncate_lines(
+        layout["desc_lines"], max_lines, "Helvetica", layout["desc_font_size"], layout["desc_w"]
+    )
+    used_desc_h = len(truncated) * layout["line_h"]
+    layout["desc_lines"] = truncated
+    layout["desc_h"] = used_desc_h
+    layout["desc_row_h"] = max(layout["qr_size"], used_desc_h + 2 * mm)
+    layout["block_h"] = fixed_part_h + layout["desc_row_h"]
+    layout["remaining"] = available_height - layout["block_h"]
+    return layout
+
+
+def _descriptions(count: int, seed: int = 7) -> list[str]:
+    rng = random.Random(seed)
+    texts = ["", " ", "\n\n", "x" * 400, "palabra " * 150]
+    while len(texts) < count:
+        target = rng.choice((40, 200, 600, 900, 1000, 1001, 1400, 2000))
+        parts: list[str] = []
+        length = 0
+        while length < target:
+            roll = rng.random()
+            if roll < 0.03:
+                word = "\n"
+            elif roll < 0.05:
+                word = "".join(rng.choice("abcdefghij") for _ in range(rng.randint(40, 120)))
+            else:
+                word = rng.choice(_WORDS)
+            parts.append(word)
+            length += len(word) + 1
+        texts.append(" ".join(parts)[:target])
+    return texts
+
+
+def test_solver_matches_linear_scan():
+    # Every generated description at several font settings and heights: the
+    # solver must pick exactly the layout of the original linear scan.
+    min_margin = 3 * mm
+    heights = [h * mm for h in (150, 180, 200, 207, 215, 230, 260)]
+    font_settings = (8.0, 9.0, 9.3, 11.5, 14.0)
+    mismatches = []
+    for text in _descriptions(60):
+        for font_setting in font_settings:
+            for height in heights:
+                pdf_generator._WRAP_CACHE.clear()
+                solved = _solve_layout(text, font_setting, height, min_margin)
+                scanned = _scan_layout(text, font_setting, height, min_margin)
+                if solved != scanned:
+                    mismatches.append((text[:40], font_setting, height))
+    assert not mismatches, mismatches[:5]
@@ -0,0 +1,109 @@
+import random
+
+from reportlab.pdfbase.pdfmetrics import stringWidth
+
+from text_metrics import string_width, truncate_lines, wrap_text
+
+
+def _reference_wrap(text: str, font_name: str, font_size: float, max_width: float) -> list[str]:
+    # The original wrapper: re-measures the growing line with stringWidth for
+    # every word and every character of a split word.
+    if not text:
+        return []
+
+    def split_long_word(word: str) -> list[str]:
+        chunks: list[str] = []
+        current = ""
+        for char in word:
+            probe = current + char
+            if stringWidth(probe, font_name, font_size) <= max_width or not current:
+                current = probe
+            else:
+                chunks.append(current)
+                current = char
+        if current:
+            chunks.append(current)
+        return chunks
+
+    lines: list[str] = []
+    for paragraph in str(text).replace("\r", "").split("\n"):
+        words = paragraph.split()
+        if not words:
+            lines.append("")
+            continue
+        current = ""
+        for word in words:
+            probe = word if not current else f"{current} {word}"
+            if stringWidth(probe, font_name, font_size) <= max_width:
+                current = probe
+                continue
+            if current:
+                lines.append(current)
+                current = ""
+            if stringWidth(word, font_name, font_size) <= max_width:
+                current = word
+            else:
+                chunks = split_long_word(word)
+                if chunks:
+                    lines.extend(chunks[:-1])
+                    current = chunks[-1]
+        if current:
+            lines.append(current)
+    return lines
+
+
+def _reference_truncate(
+    lines: list[str], max_lines: int, font_name: str, font_size: float, max_width: float
+) -> list[str]:
+    if max_lines <= 0:
+        return []
+    if len(lines) <= max_lines:
+        return lines
+    clipped = lines[:max_lines]
+    last = clipped[-1].rstrip()
+    while last and stringWidth(f"{last}…", font_name, font_size) > max_width:
+        last = last[:-1]
+    clipped[-1] = f"{last}…" if last else "…"
+    return clipped
+
+
+def _texts(count: int, seed: int = 11) -> list[str]:
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnñopqrstuvwxyzáéíóúüçABCDEFGMW0123456789.,;:!?¿¡€²()-/@_ "
+    exotic = "αβγ中文✓→☎\t "
+    texts = ["", " ", "\n", "a\r\nb", "W" * 300, "https://example.com/" + "x" * 500]
+    while len(texts) < count:
+        length = rng.choice((5, 40, 200, 800, 1500))
+        chars = []
+        for _ in range(length):
+            roll = rng.random()
+            if roll < 0.02:
+                chars.append("\n")
+            elif roll < 0.04:
+                chars.append(rng.choice(exotic))
+            else:
+                chars.append(rng.choice(alphabet))
+        texts.append("".join(chars))
+    return texts
+
+
+def test_wrap_and_truncate_match_stringwidth_probing():
+    # Random texts, fonts, sizes and widths: wrapping, splitting of long
+    # words and truncation must cut exactly where stringWidth probing does.
+    rng = random.Random(3)
+    mismatches = []
+    for text in _texts(1000):
+        font_name = rng.choice(("Helvetica", "Helvetica-Bold"))
+        font_size = rng.choice((7.5, 8.0, 9.0, 9.3, 13.0, 22.0))
+        max_width = rng.choice((5.0, 40.0, 120.0, 168.0, 452.5, 540.0))
+        max_lines = rng.randint(0, 12)
+
+        lines = wrap_text(text, font_name, font_size, max_width)
+        clipped = truncate_lines(lines, max_lines, font_name, font_size, max_width)
+        expected = _reference_wrap(text, font_name, font_size, max_width)
+        expected_clipped = _reference_truncate(expected, max_lines, font_name, font_size, max_width)
+
+        widths_match = string_width(text, font_name, font_size) == stringWidth(text, font_name, font_size)
+        if lines != expected or clipped != expected_clipped or not widths_match:
+            mismatches.append((text[:40], font_name, font_size, max_width))
+    assert not mismatches, mismatches[:5]
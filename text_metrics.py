@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from itertools import accumulate
+
+from reportlab.lib.rl_accel import unicode2T1
+from reportlab.pdfbase import pdfmetrics
+
+ELLIPSIS = "…"
+
+
+class FontWidths:
+    # Per-character advance widths of a standard Type1 font in AFM units
+    # (1/1000 em), including the Symbol/ZapfDingbats substitution reportlab
+    # applies to characters outside WinAnsi. Widths are integers, so a sum of
+    # them scaled by ``0.001 * size`` is exactly what pdfmetrics.stringWidth
+    # returns for the same text.
+    def __init__(self, font_name: str) -> None:
+        self.font_name = font_name
+        self._font = pdfmetrics.getFont(font_name)
+        self._fonts = [self._font] + list(self._font.substitutionFonts)
+        self._table: dict[str, int] = {}
+        for code in range(256):
+            try:
+                char = bytes([code]).decode("cp1252")
+            except UnicodeDecodeError:
+                continue
+            self.char_units(char)
+
+    def char_units(self, char: str) -> int:
+        units = self._table.get(char)
+        if units is None:
+            units = sum(sum(map(f.widths.__getitem__, t)) for f, t in unicode2T1(char, self._fonts))
+            self._table[char] = units
+        return units
+
+    def units(self, text: str) -> int:
+        table = self._table
+        total = 0
+        for char in text:
+            units = table.get(char)
+            total += units if units is not None else self.char_units(char)
+        return total
+
+    def prefix_units(self, text: str) -> list[int]:
+        # prefix[i] is the width of text[:i].
+        return [0, *accumulate(map(self.char_units, text))]
+
+
+@lru_cache(maxsize=None)
+def font_widths(font_name: str) -> FontWidths:
+    return FontWidths(font_name)
+
+
+def to_points(units: int, font_size: float) -> float:
+    # Same expression and evaluation order as reportlab's stringWidth.
+    return units * 0.001 * font_size
+
+
+def string_width(text: str, font_name: str, font_size: float) -> float:
+    return to_points(font_widths(font_name).units(text), font_size)
+
+
+def split_long_word(word: str, font_name: str, font_size: float, max_width: float) -> list[str]:
+    # Greedy character split; a chunk always takes at least one character.
+    widths = font_widths(font_name)
+    chunks: list[str] = []
+    start = 0
+    current_units = 0
+    for i, char in enumerate(word):
+        char_units = widths.char_units(char)
+        if i == start or to_points(current_units + char_units, font_size) <= max_width:
+            current_units += char_units
+        else:
+            chunks.append(word[start:i])
+            start = i
+            current_units = char_units
+    if start < len(word):
+        chunks.append(word[start:])
+    return chunks
+
+
+def wrap_text(text: str, font_name: str, font_size: float, max_width: float) -> list[str]:
+    # Greedy word wrap over whitespace-separated words; blank paragraphs give
+    # empty lines and words wider than a line are split by characters. The
+    # running line width is kept in units, so each word is measured once.
+    if not text:
+        return []
+    widths = font_widths(font_name)
+    space_units = widths.char_units(" ")
+    lines: list[str] = []
+    for paragraph in str(text).replace("\r", "").split("\n"):
+        words = paragraph.split()
+        if not words:
+            lines.append("")
+            continue
+        current: list[str] = []
+        current_units = 0
+        for word in words:
+            word_units = widths.units(word)
+            probe_units = current_units + space_units + word_units if current else word_units
+            if to_points(probe_units, font_size) <= max_width:
+                current.append(word)
+                current_units = probe_units
+                continue
+
+            if current:
+                lines.append(" ".join(current))
+                current = []
+                current_units = 0
+
+            if to_points(word_units, font_size) <= max_width:
+                current = [word]
+                current_units = word_units
+            else:
+                chunks = split_long_word(word, font_name, font_size, max_width)
+                if chunks:
+                    lines.extend(chunks[:-1])
+                    current = [chunks[-1]]
+                    current_units = widths.units(chunks[-1])
+
+        if current:
+            lines.append(" ".join(current))
+
+    return lines
+
+
+def truncate_lines(
+    lines: list[str],
+    max_lines: int,
+    font_name: str,
+    font_size: float,
+    max_width: float,
+) -> list[str]:
+    # Keeps ``max_lines`` lines and shortens the last one, character by
+    # character from the end, until it fits with an ellipsis appended.
+    if max_lines <= 0:
+        return []
+    if len(lines) <= max_lines:
+        return lines
+
+    clipped = lines[:max_lines]
+    last = clipped[-1].rstrip()
+    widths = font_widths(font_name)
+    prefix = widths.prefix_units(last)
+    ellipsis_units = widths.units(ELLIPSIS)
+    end = len(last)
+    while end and to_points(prefix[end] + ellipsis_units, font_size) > max_width:
+        end -= 1
+    last = last[:end]
+    clipped[-1] = f"{last}{ELLIPSIS}" if last else ELLIPSIS
+    return clipped